@@ -11,9 +11,12 @@ Usage:
 Options:
   -C PATH, --directory PATH  set working directory
   -f PATH, --file PATH       set build manifest path (overrides -C)
+  -j N, --jobs N             set concurrency budget shared by nested tools, defaults to core count
   -m STR, --message STR      set commit message
-  -p ID, --profile ID        set build profile
+  -p ID, --profile ID        set build profile, run profiles concurrently if comma-separated
   -v, --verbose              trace execution
+  -w, --watch                rerun targets whenever the workspace changes
+  -x, --fail-fast            abort the run on the first test failure
   -h, --help                 display full help text
   --no-color                 disable colored output
 
@@ -23,6 +26,7 @@ TARGET:
   * compile         generate target objects from source code
   * run[:ID]        execute entry point(s)
   * test            run unit tests
+  * bench           run benchmarks, compare with previous results
   * release:ID      bump source code version, commit, tag and push
   * package[:ID]    package target objects [in the identified format]
   * publish[:ID]    publish package(s) [to the identified repository]
@@ -33,6 +37,7 @@ Lifecycles:
   * get
   * clean
   * run < compile
+  * bench < compile
   * release < test < compile
   * publish < package < test < compile
   * install < package < test < compile
@@ -54,10 +59,12 @@ Use '~/build.json' to customize commands:
   }
 """
 
-import textwrap, fnmatch, glob, os
+import multiprocessing.pool, multiprocessing, ctypes.util, atexit, subprocess, threading, textwrap, fnmatch, inspect, select, shutil, ctypes, struct, errno, glob, json, time, sys, os, re
 
 import docopt, fckit # 3rd-party
 
+import builtin # in-process file operations, shared with the builtin stack
+
 MANIFESTS = tuple(dict({"name": name}, **__import__(name, globals()).MANIFEST) for name in (
 	"ansible",
 	"ant",
@@ -79,25 +86,142 @@ MANIFESTS = tuple(dict({"name": name}, **__import__(name, globals()).MANIFEST) f
 	"universe",
 	"vagrant"))
 
+# options translating the concurrency budget for tools not sharing the jobserver:
+JOBS_OPTIONS = {
+	"mvn": lambda jobs: ("--threads", "%i" % jobs),
+	"ninja": lambda jobs: ("-j", "%i" % jobs),
+}
+
+# directories never walked by @sweep: VCS metadata, third-party code
+SWEEP_PRUNED = (".git", ".hg", ".svn", ".tox", ".nox", "node_modules")
+
+MATRIX_PATH = ".buildstack/matrix" # workspace clones of the last matrix run, per profile
+
 class Error(fckit.Error): pass
 
+def load_json(path):
+	"return the JSON document stored at $path, or {} if missing or unreadable"
+	try:
+		with open(path, "r") as fp:
+			return json.load(fp)
+	except (IOError, ValueError):
+		return {}
+
+def save_json(path, data):
+	"store $data as a JSON document at $path, creating its directory if needed"
+	if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, "w") as fp:
+		json.dump(data, fp, indent = 1, sort_keys = True)
+
+class Jobserver(object):
+	"""
+	GNU make jobserver: a pipe holding one token per job slot,
+	minus the slot implicitly owned by each process.
+	Nested tools (make, cargo, buildstack) join it through MAKEFLAGS and CARGO_MAKEFLAGS.
+	"""
+
+	def __init__(self, jobs = None):
+		flags = os.environ.get("MAKEFLAGS", "")
+		self.environ = {key: os.environ.get(key) for key in ("MAKEFLAGS", "CARGO_MAKEFLAGS")}
+		self.started = False
+		fifo = re.search(r"--jobserver-auth=fifo:(\S+)", flags) # make >= 4.4
+		match = re.search(r"--jobserver-(?:auth|fds)=(\d+),(\d+)", flags)
+		if fifo and os.path.exists(fifo.group(1)):
+			# join the parent jobserver through its named pipe:
+			self.rfd = self.wfd = os.open(fifo.group(1), os.O_RDWR)
+			self.fds = (self.rfd,)
+			self.jobs = self._get_jobs(flags)
+		elif match and self._is_open(*map(int, match.groups())):
+			# join the parent jobserver, its descriptors are inherited:
+			self.rfd, self.wfd = map(int, match.groups())
+			self.fds = ()
+			self.jobs = self._get_jobs(flags)
+		else:
+			try:
+				self.jobs = int(jobs or multiprocessing.cpu_count())
+				assert self.jobs > 0
+			except (ValueError, AssertionError):
+				raise Error(jobs, "expected a positive number of jobs")
+			self.rfd, self.wfd = self.fds = os.pipe()
+			self.started = True
+			os.write(self.wfd, "+" * (self.jobs - 1))
+			flags = re.sub(r"(?:^|\s)-j\s*\d*", "", flags).strip() # let the jobserver set concurrency
+			os.environ["MAKEFLAGS"] = os.environ["CARGO_MAKEFLAGS"] = " ".join(filter(None, (
+				flags,
+				"-j%i" % self.jobs,
+				"--jobserver-fds=%i,%i" % (self.rfd, self.wfd)))) # understood by make >= 3.78 and cargo
+			fckit.trace("jobserver started with", self.jobs, "slot(s)")
+
+	@staticmethod
+	def _get_jobs(flags):
+		match = re.search(r"(?:^|\s)-j\s*(\d+)", flags)
+		return int(match.group(1)) if match else multiprocessing.cpu_count()
+
+	@staticmethod
+	def _is_open(*fds):
+		try:
+			for fd in fds:
+				os.fstat(fd)
+			return True
+		except OSError:
+			return False
+
+	def acquire(self):
+		"block until a job slot is available and return its token"
+		return os.read(self.rfd, 1)
+
+	def release(self, token):
+		os.write(self.wfd, token)
+
+	def close(self):
+		"close the descriptors opened by this jobserver and, if started here, restore the environment"
+		for fd in self.fds:
+			os.close(fd)
+		self.fds = ()
+		if self.started:
+			for key, value in self.environ.items():
+				if value is None:
+					os.environ.pop(key, None)
+				else:
+					os.environ[key] = value
+			self.started = False
+
+_jobserver = None
+
+def get_jobserver(jobs = None):
+	"return the jobserver of this process: started (or joined) on first call, closed at exit"
+	global _jobserver
+	if not _jobserver:
+		_jobserver = Jobserver(jobs)
+		atexit.register(_jobserver.close)
+	return _jobserver
+
 class Vcs(object):
 
 	def __init__(self):
+		self.attr = {}
 		for key in (".hg", ".git", ".svn"):
 			if os.path.exists(key):
 				self.attr = {
 					".git": {
 						"commit": lambda message: ("git", "commit", "-am", message),
+						"diff": lambda revision: ("git", "diff", "--name-only", "--relative", revision),
+						"ignored": lambda: ("git", "ls-files", "--others", "--ignored", "--exclude-standard", "--directory"),
 						"purge": lambda: ("git", "clean", "--force", "-d", "-x"),
 						"push": lambda: ("git", "push", "--follow-tags"), # work with annotated tags
+						"revision": lambda: ("git", "rev-parse", "HEAD"),
 						"tag": lambda name: ("git", "tag", "-a", "-m", "release", name),
+						"untracked": lambda: ("git", "ls-files", "--others", "--exclude-standard"),
 					},
 					".svn": {},
 					".hg": {
 						"commit": lambda message: ("hg", "commit", "-m", message),
+						"diff": lambda revision: ("hg", "status", "--no-status", "--rev", revision, "."),
+						"ignored": lambda: ("hg", "status", "--no-status", "--ignored", "."),
 						"purge": lambda: ("hg", "purge", "--config", "extensions.purge="),
 						"push": lambda: ("hg", "push"),
+						"revision": lambda: ("hg", "log", "--rev", ".", "--template", "{node}"),
 						"tag": lambda name: ("hg", "tag", name),
 					},
 				}[key]
@@ -108,14 +232,45 @@ class Vcs(object):
 		except KeyError:
 			raise Error("unsupported operation")
 
+	def get_revision(self):
+		"return the current revision id, or None if unsupported"
+		try:
+			return fckit.check_output(*self.revision()).strip()
+		except fckit.Error: # e.g. no vcs or no commit yet
+			return None
+
+	def get_changes(self, revision):
+		"return the paths changed since $revision, including uncommitted and untracked changes, or None if unsupported"
+		try:
+			changes = fckit.check_output(*self.diff(revision)).splitlines()
+			if "untracked" in self.attr: # hg status lists them already
+				changes += fckit.check_output(*self.untracked()).splitlines()
+			return changes
+		except fckit.Error: # e.g. no vcs or unknown revision
+			return None
+
+	def get_ignored(self):
+		"return the ignored paths, directories ending with a slash, or None if unsupported"
+		try:
+			return fckit.check_output(*self.ignored()).splitlines()
+		except fckit.Error: # e.g. no vcs
+			return None
+
 class Version(object):
 	"immutable N(.N)* version object"
 
+	@staticmethod
+	def parse(string):
+		try:
+			number = map(int, string.strip().split("."))
+		except ValueError:
+			raise Error(string.strip(), "expected N(.N)* version")
+		return Version(*number)
+
 	@staticmethod
 	def parse_stdout(*args):
 		stdout = fckit.check_output(*args)
-		number = map(int, stdout.split("."))
-		return Version(*number)
+		return Version.parse(stdout)
 
 	def __init__(self, *number):
 		self.number = number
@@ -169,6 +324,60 @@ class Target(object):
 		except KeyError:
 			return None
 
+def _is_virtualenv(path):
+	return os.path.exists(os.path.join(path, "pyvenv.cfg")) or os.path.exists(os.path.join(path, "bin", "activate"))
+
+def sweep(patterns, jobs = 1, batch_size = 256):
+	"""
+	Remove the files and directories of the workspace matching any pattern, return their count.
+	Patterns starting with / are matched from the workspace root, others against basenames at any depth.
+	The walk does not descend into matched directories, VCS metadata, virtualenvs or node_modules.
+	"""
+	paths = set()
+	for pattern in patterns:
+		if pattern.startswith("/"):
+			paths.update(glob.glob(pattern[1:]))
+	patterns = [pattern for pattern in patterns if not pattern.startswith("/")]
+	if patterns:
+		stack = ["."]
+		while stack:
+			dirname = stack.pop()
+			for basename in os.listdir(dirname):
+				path = os.path.normpath(os.path.join(dirname, basename))
+				if path in paths:
+					continue
+				elif any(fnmatch.fnmatch(basename, pattern) for pattern in patterns):
+					paths.add(path)
+				elif os.path.isdir(path)\
+				and not os.path.islink(path)\
+				and basename not in SWEEP_PRUNED\
+				and not _is_virtualenv(path):
+					stack.append(path)
+	def remove(batch):
+		errors = []
+		for path in batch:
+			try:
+				if os.path.isdir(path) and not os.path.islink(path):
+					shutil.rmtree(path)
+				else:
+					os.remove(path)
+			except OSError as exc:
+				errors.append("%s: %s" % (path, exc.strerror))
+		return errors
+	paths = sorted(paths)
+	batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+	if len(batches) > 1 and jobs > 1:
+		pool = multiprocessing.pool.ThreadPool(min(jobs, len(batches)))
+		try:
+			errors = sum(pool.map(remove, batches), [])
+		finally:
+			pool.close()
+	else:
+		errors = sum(map(remove, batches), [])
+	if errors:
+		raise Error("unable to remove", *errors)
+	return len(paths)
+
 class Targets(list):
 
 	def append(self, name, **kwargs):
@@ -178,7 +387,7 @@ class Targets(list):
 
 class BuildStack(object):
 
-	def __init__(self, preferences = None, profileid = None, manifests = None, path = None):
+	def __init__(self, preferences = None, profileid = None, manifests = None, path = None, jobs = None, failfast = False):
 		# resolve preferences:
 		if preferences:
 			self.preferences = preferences.get("all", {})
@@ -221,18 +430,66 @@ class BuildStack(object):
 			raise Error("this build stack is still under development, request support on github")
 		self.targets = Targets()
 		self.vcs = Vcs()
+		self.jobserver = get_jobserver(jobs)
+		self.failfast = failfast
+		# let build stacks map the profile onto their own, e.g. cargo build profiles
+		if profileid:
+			os.environ["BUILDSTACK_PROFILE"] = profileid
+		else:
+			os.environ.pop("BUILDSTACK_PROFILE", None)
 
-	def _check_call(self, args):
+	def _resolve(self, args):
+		"return the commands (before, main, after) to run for $args, according to preferences"
 		prefs = self.preferences.get(args[0], {})
 		args = list(args)
+		if args[0] in JOBS_OPTIONS and not any(arg.startswith(("-j", "-T", "--threads")) for arg in args[1:] + prefs.get("append", [])):
+			args += JOBS_OPTIONS[args[0]](self.jobserver.jobs)
 		args[0] = prefs.get("path", args[0])
-		argslist = prefs.get("before", []) + [args + prefs.get("append", [])] + prefs.get("after", [])
-		for args in argslist:
-			args[0] = fckit.Path(args[0])
+		fix = lambda args: [fckit.Path(args[0])] + list(args[1:])
+		return (
+			map(fix, prefs.get("before", [])),
+			fix(args + prefs.get("append", [])),
+			map(fix, prefs.get("after", [])))
+
+	def _check_call(self, args):
+		before, args, after = self._resolve(args)
+		for args in before + [args] + after:
 			fckit.check_call(*args)
 
-	def _handle_target(self, name, default = "stack", **kwargs):
-		"generic target handler: call the custom handler if it exists, or fallback on default"
+	def _check_output(self, args):
+		"run $args as _check_call does, return the output of the main command"
+		before, args, after = self._resolve(args)
+		for args in before:
+			fckit.check_call(*args)
+		output = fckit.check_output(*args)
+		for args in after:
+			fckit.check_call(*args)
+		return output
+
+	def _check_calls(self, jobs):
+		"run (label, args) jobs concurrently within the jobs budget, raise Error if any failed"
+		jobs = [(label,) + self._resolve(args) for label, args in jobs]
+		for _, before, _, _ in jobs: # before and after commands are run sequentially
+			for args in before:
+				fckit.check_call(*args)
+		returncodes = multiplex(
+			{label: (args, {}) for label, _, args, _ in jobs},
+			jobserver = self.jobserver,
+			failfast = self.failfast)
+		failed = sorted(label for label, returncode in returncodes.items() if returncode)
+		if failed:
+			exc = Error(", ".join(failed), "failed")
+			exc.returncodes = returncodes # None if aborted, letting handlers keep track of the successful jobs
+			raise exc
+		for _, _, _, after in jobs:
+			for args in after:
+				fckit.check_call(*args)
+
+	def _handle_target(self, name, default = "stack", optional = None, **kwargs):
+		"""
+		Generic target handler: call the custom handler if it exists, or fallback on default.
+		The $optional keyword arguments are only passed to the handlers declaring them.
+		"""
 		fckit.trace(">>", "[", name, "]")
 		handler = self.manifest.get("on_%s" % name, default)
 		if handler is Exception:
@@ -242,39 +499,76 @@ class BuildStack(object):
 		elif handler == "stack": # stack target and let the on_flush handler deal with it
 			self.targets.append(name, **kwargs)
 		elif callable(handler):
-			for res in (handler)(
+			argspec = inspect.getargspec(handler)
+			for key, arg in (optional or {}).items():
+				if argspec.keywords or key in argspec.args:
+					kwargs[key] = arg
+			results = iter((handler)(
 				filename = self.filename,
 				targets = self.targets,
-				**kwargs):
-				if isinstance(res, (list, tuple)):
-					if res[0] == "@try":
-						try:
-							self._check_call(res[1:])
-						except:
-							fckit.trace("command failure ignored")
-					elif res[0] == "@tag":
-						self._check_call(self.vcs.tag(*res[1:]))
-					elif res[0] == "@push":
-						self._check_call(self.vcs.push())
-					elif res[0] == "@flush":
-						assert name != "flush", "infinite recursion detected"
-						self.flush()
-					elif res[0] == "@trace":
-						fckit.trace(*res[1:])
-					elif res[0] == "@purge":
-						self._check_call(self.vcs.purge())
-					elif res[0] == "@commit":
-						self._check_call(self.vcs.commit(*res[1:]))
-					elif res[0] == "@remove":
-						fckit.remove(*res[1:])
+				**kwargs))
+			exc_info = None
+			value = None
+			while True:
+				try:
+					if exc_info and hasattr(results, "throw"):
+						# failures are thrown back into generator handlers, letting them record state before propagation
+						res = results.throw(*exc_info)
+					elif exc_info:
+						raise exc_info[0], exc_info[1], exc_info[2]
+					elif value is not None and hasattr(results, "send"):
+						res = results.send(value) # builtin result, e.g. @resolve or @output
 					else:
-						self._check_call(res)
-				else: # res is an error object
-					raise Error(self.manifest["name"], name, res)
+						res = next(results)
+				except StopIteration:
+					break
+				exc_info = value = None
+				try:
+					value = self._handle_result(name, res)
+				except fckit.Error: # failed commands raise fckit.Error, builtins buildstack.Error
+					exc_info = sys.exc_info()
 		else:
 			raise AssertionError("invalid target handler")
 		fckit.trace("<<", "[", name, "]")
 
+	def _handle_result(self, name, res):
+		"run a command or builtin yielded by the $name handler"
+		if isinstance(res, (list, tuple)):
+			if res[0] == "@try":
+				try:
+					self._check_call(res[1:])
+				except:
+					fckit.trace("command failure ignored")
+			elif res[0] == "@tag":
+				self._check_call(self.vcs.tag(*res[1:]))
+			elif res[0] == "@push":
+				self._check_call(self.vcs.push())
+			elif res[0] == "@flush":
+				assert name != "flush", "infinite recursion detected"
+				self.flush()
+			elif res[0] == "@trace":
+				fckit.trace(*res[1:])
+			elif res[0] == "@echo":
+				print " ".join(res[1:])
+			elif res[0] == "@purge":
+				self._check_call(self.vcs.purge())
+			elif res[0] == "@commit":
+				self._check_call(self.vcs.commit(*res[1:]))
+			elif res[0] == "@remove":
+				fckit.remove(*res[1:])
+			elif res[0] == "@parallel":
+				self._check_calls(res[1:])
+			elif res[0] == "@sweep":
+				fckit.trace("swept", sweep(res[1:], jobs = self.jobserver.jobs), "lingering file(s)")
+			elif res[0] == "@resolve":
+				return self._resolve(res[1:])
+			elif res[0] == "@output":
+				return self._check_output(res[1:])
+			else:
+				self._check_call(res)
+		else: # res is an error object
+			raise Error(self.manifest["name"], name, res)
+
 	def get(self, requirementid = None):
 		self._handle_target(
 			"get",
@@ -295,7 +589,15 @@ class BuildStack(object):
 
 	def test(self):
 		self.compile()
-		self._handle_target("test")
+		self._handle_target(
+			"test",
+			optional = {"vcs": self.vcs, "failfast": self.failfast})
+
+	def bench(self):
+		self.compile()
+		self._handle_target(
+			"bench",
+			default = Exception)
 
 	def package(self, formatid = None):
 		self.test()
@@ -330,7 +632,10 @@ class BuildStack(object):
 
 	def flush(self):
 		if self.targets:
-			self._handle_target("flush", default = None)
+			self._handle_target(
+				"flush",
+				default = None,
+				optional = {"vcs": self.vcs})
 		assert not self.targets, "lingering target(s), please report this bug!"
 
 def setup(toolid, settings, manifests):
@@ -367,6 +672,280 @@ def setup(toolid, settings, manifests):
 		else:
 			raise Error(path, "file already exists, set overwrite=yes to force")
 
+def clone_workspace(src, dst):
+	"""
+	Copy the $src checkout into $dst:
+	VCS objects are immutable and hardlinked, other files are reflinked if possible, copied otherwise.
+	"""
+	for dirname, dirbasenames, basenames in os.walk(src):
+		reldirname = os.path.relpath(dirname, src)
+		dirbasenames[:] = [basename for basename in dirbasenames
+			if os.path.normpath(os.path.join(reldirname, basename)) != MATRIX_PATH] # clones of a previous matrix run
+		immutable = reldirname.split(os.sep)[:2] in ([".git", "objects"], [".hg", "store"])
+		os.makedirs(os.path.join(dst, reldirname))
+		for basename in dirbasenames + basenames:
+			if basename in dirbasenames and not os.path.islink(os.path.join(dirname, basename)):
+				continue # walked next
+			srcpath = os.path.join(dirname, basename)
+			dstpath = os.path.join(dst, reldirname, basename)
+			if os.path.islink(srcpath):
+				os.symlink(os.readlink(srcpath), dstpath)
+				continue
+			if immutable:
+				try:
+					os.link(srcpath, dstpath)
+					continue
+				except OSError as exc:
+					if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+						raise
+			if not builtin.reflink(srcpath, dstpath):
+				shutil.copy2(srcpath, dstpath)
+
+def multiplex(jobs, jobserver = None, failfast = False):
+	"""
+	Run {label: (args, kwargs)} jobs concurrently, with their output interleaved and prefixed per label.
+	If a jobserver is set, a job starts once a job slot is free: the implicit slot of this process, or a token.
+	If failfast is set, the first failure terminates the other jobs, which are then reported as None.
+	Return {label: returncode}.
+	"""
+	width = max(map(len, jobs))
+	lock = threading.Lock()
+	returncodes = {}
+	procs = {}
+	aborted = threading.Event()
+	done_rfd, done_wfd = os.pipe() # freed slots, as 2-byte records: "-_" (implicit) or "+<token>"
+	def _abort():
+		with lock:
+			aborted.set()
+			for proc in procs.values():
+				if proc.poll() is None:
+					proc.terminate()
+	def _run(label, args, kwargs, token):
+		try:
+			with lock:
+				if aborted.is_set():
+					returncodes[label] = None
+					return
+				fckit.trace(label, *args)
+				try:
+					proc = procs[label] = subprocess.Popen(args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, **kwargs)
+				except OSError as exc:
+					print fckit.magenta(label.ljust(width)), exc
+					proc = None
+			if proc:
+				for line in iter(proc.stdout.readline, ""):
+					with lock:
+						sys.stdout.write("%s %s" % (fckit.magenta(label.ljust(width)), line))
+						sys.stdout.flush()
+			returncode = proc.wait() if proc else 127
+			if aborted.is_set() and returncode <= 0: # terminated, or stopped gracefully
+				returncodes[label] = None
+			else:
+				returncodes[label] = returncode
+				if returncode and failfast:
+					_abort()
+		finally:
+			os.write(done_wfd, "+%s" % token if token else "-_")
+	pending = list(jobs.items())
+	slots = [None] # free slots, None being the implicit one
+	running = 0
+	threads = []
+	try:
+		while pending or running:
+			if pending and (slots or not jobserver):
+				label, job = pending.pop(0)
+				threads.append(threading.Thread(target = _run, args = (label,) + job + (slots.pop() if slots else None,)))
+				threads[-1].start()
+				running += 1
+				continue
+			rfds = [done_rfd] + ([jobserver.rfd] if pending else [])
+			if done_rfd in select.select(rfds, [], [])[0]:
+				record = os.read(done_rfd, 2)
+				slots.append(record[1] if record[0] == "+" else None)
+				running -= 1
+			else:
+				slots.append(jobserver.acquire())
+	finally:
+		for token in slots:
+			if token:
+				jobserver.release(token)
+		for thread in threads:
+			thread.join()
+		os.close(done_rfd)
+		os.close(done_wfd)
+	return returncodes
+
+def run_matrix(profileids, targets, path = None, options = (), jobs = None, failfast = False):
+	"""
+	Run buildstack for each profile concurrently, each in its own clone of the workspace.
+	The clones are kept under $MATRIX_PATH with their artifacts, until the next matrix run.
+	"""
+	if any(target.partition(":")[0] == "release" for target in targets):
+		raise Error("release", "cannot be run on multiple profiles")
+	path = os.path.abspath(fckit.Path(path or "."))
+	if os.path.isdir(path):
+		dirname, basename = path, None
+	else:
+		dirname, basename = os.path.split(path)
+	jobserver = get_jobserver(jobs) # shared by all profiles
+	runs = {}
+	for profileid in profileids:
+		workspace = os.path.join(dirname, MATRIX_PATH, profileid)
+		if os.path.exists(workspace):
+			fckit.remove(workspace)
+		fckit.trace("cloning workspace for profile", profileid)
+		clone_workspace(dirname, workspace)
+		args = [sys.executable, "-m", __name__, "--profile", profileid]
+		if basename:
+			args += ["--file", os.path.join(workspace, basename)]
+		else:
+			args += ["--directory", workspace]
+		runs[profileid] = (args + list(options) + list(targets), {})
+	start = time.time()
+	returncodes = multiplex(runs, jobserver = jobserver, failfast = failfast)
+	for profileid in profileids:
+		if returncodes[profileid] is None:
+			status = fckit.cyan("aborted")
+		elif returncodes[profileid]:
+			status = fckit.red("failed (%i)" % returncodes[profileid])
+		else:
+			status = fckit.green("ok")
+		print "%s: %s" % (profileid, status)
+	fckit.trace("matrix run took %.1fs, workspaces kept in %s" % (time.time() - start, MATRIX_PATH))
+	failed = sorted(profileid for profileid in profileids if returncodes[profileid])
+	if failed:
+		raise Error(", ".join(failed), "profile(s) failed")
+
+class Watcher(object):
+	"report paths changed under the current directory, using inotify if available, polling otherwise"
+
+	# inotify(7) constants
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_FROM = 0x40
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_DELETE = 0x200
+	IN_ISDIR = 0x40000000
+
+	def __init__(self, polling_delay = 1):
+		self.fd = None
+		self.polling_delay = polling_delay
+		if sys.platform.startswith("linux"):
+			self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+			fd = self.libc.inotify_init()
+			if fd >= 0:
+				self.fd = fd
+				self.wds = {}
+				self._add_watches(".")
+		if self.fd is None:
+			fckit.trace("inotify unavailable, polling workspace")
+			self.mtimes = self._scan()
+
+	@staticmethod
+	def _is_ignored(basename):
+		return basename.startswith(".") or basename.endswith("~") # VCS, caches, editor backups
+
+	def _walk(self, path):
+		for dirname, dirbasenames, basenames in os.walk(path):
+			dirbasenames[:] = [basename for basename in dirbasenames if not self._is_ignored(basename)]
+			yield dirname, [basename for basename in basenames if not self._is_ignored(basename)]
+
+	def _add_watches(self, path):
+		mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+		for dirname, _ in self._walk(path):
+			wd = self.libc.inotify_add_watch(self.fd, dirname, mask)
+			if wd >= 0:
+				self.wds[wd] = dirname
+
+	def _scan(self):
+		mtimes = {}
+		for dirname, basenames in self._walk("."):
+			for basename in basenames:
+				path = os.path.normpath(os.path.join(dirname, basename))
+				try:
+					mtimes[path] = os.stat(path).st_mtime
+				except OSError:
+					pass # deleted meanwhile
+		return mtimes
+
+	def _get_changes(self, timeout):
+		"return the set of paths changed within $timeout seconds (None to wait for the first change)"
+		changes = set()
+		if self.fd is not None:
+			if select.select([self.fd], [], [], timeout)[0]:
+				data = os.read(self.fd, 65536)
+				offset = 0
+				while offset < len(data):
+					wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+					basename = data[offset + 16:offset + 16 + length].rstrip("\0")
+					offset += 16 + length
+					if wd in self.wds and basename and not self._is_ignored(basename):
+						path = os.path.normpath(os.path.join(self.wds[wd], basename))
+						if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+							self._add_watches(path)
+						changes.add(path)
+		else:
+			deadline = None if timeout is None else time.time() + timeout
+			while True:
+				mtimes = self._scan()
+				changes = set(path
+					for path in set(mtimes) | set(self.mtimes)
+						if mtimes.get(path) != self.mtimes.get(path))
+				self.mtimes = mtimes
+				if changes or (deadline is not None and time.time() >= deadline):
+					break
+				time.sleep(self.polling_delay if deadline is None else min(self.polling_delay, max(0, deadline - time.time())))
+		return changes
+
+	def wait(self, delay = .2):
+		"block until something changes and return the changed paths once no change occurred for $delay seconds"
+		changes = self._get_changes(None)
+		while True:
+			burst = self._get_changes(delay)
+			if not burst:
+				return changes
+			changes |= burst
+
+	def drain(self):
+		"discard pending changes"
+		while self._get_changes(0):
+			pass
+
+def watch(bs, run, targets):
+	"""
+	Run targets, then wait for changes and rerun the affected lifecycles until interrupted:
+	requirement file changes trigger 'get' and all targets, other changes trigger all targets but 'get'.
+	"""
+	watcher = Watcher()
+	selected = targets
+	try:
+		while True:
+			watcher.drain() # changes seen by the previous wait; the ones saved during the run trigger the next one
+			try:
+				run(selected)
+			except Exception as exc: # e.g. a handler bug, keep watching
+				print fckit.red(exc)
+				del bs.targets[:] # do not flush the targets of the failed run next time
+			print fckit.cyan("watching for changes, press Ctrl+C to exit")
+			while True:
+				changes = watcher.wait()
+				ignored = bs.vcs.get_ignored() or () # e.g. build outputs, would retrigger runs forever
+				changes = set(path for path in changes
+					if not any(path == ignored_path.rstrip("/") or (ignored_path.endswith("/") and path.startswith(ignored_path))
+						for ignored_path in ignored))
+				if changes:
+					break
+				fckit.trace("ignored changes only, still watching")
+			fckit.trace("changed:", *sorted(changes))
+			if any(fnmatch.fnmatch(os.path.basename(path), pattern)
+				for path in changes
+					for pattern in bs.manifest.get("requirements", ())):
+				selected = targets if any(target.partition(":")[0] == "get" for target in targets) else ["get"] + targets
+			else:
+				selected = [target for target in targets if target.partition(":")[0] != "get"]
+	except KeyboardInterrupt:
+		pass
+
 def main(args = None):
 	opts = docopt.docopt(
 		doc = __doc__,
@@ -381,18 +960,34 @@ def main(args = None):
 				toolid = opts["TOOLID"],
 				settings = opts["SETTING"],
 				manifests = MANIFESTS)
+		elif opts["--profile"] and "," in opts["--profile"]:
+			if opts["--watch"]:
+				raise Error("--watch", "cannot be used with multiple profiles")
+			run_matrix(
+				profileids = opts["--profile"].split(","),
+				targets = opts["TARGETS"],
+				path = opts["--file"] or opts["--directory"],
+				jobs = opts["--jobs"],
+				failfast = opts["--fail-fast"],
+				options = (["--message", opts["--message"]] if opts["--message"] else [])\
+					+ (["--fail-fast"] if opts["--fail-fast"] else [])\
+					+ (["--verbose"] if opts["--verbose"] else [])\
+					+ (["--no-color"] if opts["--no-color"] else []))
 		else:
 			bs = BuildStack(
 				preferences = fckit.unmarshall("~/buildstack.json"),
 				profileid = opts["--profile"],
 				manifests = MANIFESTS,
-				path = opts["--file"] or opts["--directory"])
+				path = opts["--file"] or opts["--directory"],
+				jobs = opts["--jobs"],
+				failfast = opts["--fail-fast"])
 			switch = {
 				"get": lambda value: bs.get(requirementid = value),
 				"clean": lambda _: bs.clean(),
 				"compile": lambda _: bs.compile(),
 				"run": lambda value: bs.run(entrypointid = value),
 				"test": lambda _: bs.test(),
+				"bench": lambda _: bs.bench(),
 				"release": lambda value: bs.release(
 					partid = value,
 					message = opts["--message"]),
@@ -401,12 +996,17 @@ def main(args = None):
 				"install": lambda value: bs.install(inventoryid = value),
 				"uninstall": lambda value: bs.uninstall(inventoryid = value),
 			}
-			for target in opts["TARGETS"]:
-				key, _, value = target.partition(":")
-				if key in switch:
-					switch[key](value)
-				else:
-					raise Error(target, "unknown target, call --help for details")
-			bs.flush()
+			def run(targets):
+				for target in targets:
+					key, _, value = target.partition(":")
+					if key in switch:
+						switch[key](value)
+					else:
+						raise Error(target, "unknown target, call --help for details")
+				bs.flush()
+			if opts["--watch"]:
+				watch(bs, run, opts["TARGETS"])
+			else:
+				run(opts["TARGETS"])
 	except fckit.Error as exc:
 		raise SystemExit(fckit.red(exc))
@@ -1,48 +1,263 @@
 # copyright (c) 2015 fclaerhout.fr, released under the MIT license.
 
-import ConfigParser, yaml, os
+import ConfigParser, tempfile, hashlib, shutil, yaml, os, re
+
+import buildstack # core helpers, looked up at call time
 
 cat = lambda *args: args
 
+CACHE_PATH = os.path.expanduser("~/.buildstack/ansible") # installed roles, per name and version
+
+STATE_PATH = ".buildstack/ansible.json" # fingerprints of the playbooks which passed the syntax check
+
+INCLUDE_KEYS = ("include", "import_playbook", "include_tasks", "import_tasks", "include_vars", "vars_files")
+
+INCLUDE_ROLE_KEYS = ("include_role", "import_role")
+
+PRUNED_DIRNAMES = ("roles", "group_vars", "host_vars") # never hold playbooks
+
 def get_roles_path():
+	"return the directory where roles are installed, the first one of roles_path"
 	parser = ConfigParser.ConfigParser()
 	parser.read("ansible.cfg")
 	if parser.has_option("defaults", "roles_path"):
-		return parser.get("defaults", "roles_path")
+		return parser.get("defaults", "roles_path").split(os.pathsep)[0]
+	return "roles"
+
+def parse_requirement(req):
+	"return (src, version, name) of the role requirement $req, a dict or a 'src[,version[,name]]' string"
+	if isinstance(req, dict):
+		src, version, name = req.get("src", req.get("name")), req.get("version"), req.get("name")
+		if req.get("scm") and not src.startswith("%s+" % req["scm"]):
+			src = "%s+%s" % (req["scm"], src)
+	else:
+		src, version, name = (req.split(",") + [None, None])[:3]
+	if not name: # as named by ansible-galaxy
+		name = re.sub(r"(\.git|\.tar\.gz)$", "", src.rstrip("/").split("/")[-1].split(",")[0])
+	return src, "%s" % version if version else None, name # versions may be parsed as numbers
+
+def load_requirements(path):
+	"return the (src, version, name) of the roles required by the file $path"
+	with open(path, "r") as fp:
+		requirements = yaml.safe_load(fp) or []
+	if isinstance(requirements, dict): # collections format
+		requirements = requirements.get("roles", [])
+	return map(parse_requirement, requirements)
+
+def get_installed_version(path):
+	"return the version of the role installed in $path by ansible-galaxy, if any"
+	try:
+		with open(os.path.join(path, "meta", ".galaxy_install_info"), "r") as fp:
+			version = (yaml.safe_load(fp) or {}).get("version")
+	except IOError:
+		return None
+	return "%s" % version if version else None
+
+def get_dependencies(path):
+	"return the (src, version, name) of the galaxy roles required by the meta of the role $path"
+	try:
+		with open(os.path.join(path, "meta", "main.yml"), "r") as fp:
+			meta = yaml.safe_load(fp) or {}
+	except IOError:
+		return []
+	dependencies = []
+	for dep in meta.get("dependencies") or []:
+		if isinstance(dep, dict) and "src" not in dep:
+			dep = dep.get("role", dep.get("name"))
+		src, version, name = parse_requirement(dep)
+		if "." in src or "." in name: # as ansible-galaxy does, others are local roles
+			dependencies.append((src, version, name))
+	return dependencies
 
 def on_get(filename, targets, requirementid):
-	# create roles_path if it does not exist:
 	roles_path = get_roles_path()
 	if not os.path.exists(roles_path):
-		os.mkdir(roles_path)
-	if os.path.exists(requirementid):
-		# meet requirements file:
-		args = ("--role-file", requirementid)
+		os.makedirs(roles_path)
+	if requirementid and not os.path.exists(requirementid):
+		requirements = [parse_requirement(requirementid)] # single role
 	else:
-		# get single module:
-		if not re.match("\w\.\w(,\w)?", requirementid):
-			yield "%s: expected id format 'username.rolename[,version]' format" % requirementid
-		args = (requirementid,)
-	yield cat("ansible-galaxy", "install", "--force", *args)
+		requirements = load_requirements(requirementid or "requirements.yml")
+	if not os.path.exists(CACHE_PATH):
+		os.makedirs(CACHE_PATH)
+	# cached roles are not installed by ansible-galaxy: require their dependencies explicitly
+	names = set(name for _, _, name in requirements)
+	for src, version, name in requirements: # extended while iterated
+		if version and os.path.exists(os.path.join(CACHE_PATH, name, version)):
+			for dep in get_dependencies(os.path.join(CACHE_PATH, name, version)):
+				if dep[2] not in names:
+					names.add(dep[2])
+					requirements.append(dep)
+	tmpdir = tempfile.mkdtemp(prefix = ".", dir = CACHE_PATH) # on the cache filesystem, to rename into it
+	try:
+		# fetch the roles missing from the cache concurrently, each into its own roles path;
+		# unversioned roles may move, they are always fetched
+		jobs = []
+		for src, version, name in requirements:
+			if not version or not os.path.exists(os.path.join(CACHE_PATH, name, version)):
+				jobs.append((name, cat(
+					"ansible-galaxy", "install",
+					"--roles-path", os.path.join(tmpdir, name),
+					"%s,%s,%s" % (src, version or "", name))))
+		yield "@trace", len(requirements) - len(jobs), "cached role(s),", len(jobs), "to fetch"
+		if len(jobs) > 1:
+			yield ("@parallel",) + tuple(jobs)
+		elif jobs:
+			yield jobs[0][1]
+		for src, version, name in requirements:
+			dirname = os.path.join(tmpdir, name)
+			path = os.path.join(CACHE_PATH, name, version) if version else os.path.join(dirname, name)
+			if os.path.exists(dirname):
+				for depname in os.listdir(dirname): # dependencies fetched along, not cached
+					if depname != name and not os.path.exists(os.path.join(roles_path, depname)):
+						shutil.move(os.path.join(dirname, depname), os.path.join(roles_path, depname))
+				if version:
+					try:
+						if not os.path.exists(os.path.dirname(path)):
+							os.makedirs(os.path.dirname(path))
+						os.rename(os.path.join(dirname, name), path)
+					except OSError:
+						if not os.path.exists(path): # not cached concurrently
+							raise
+			target = os.path.join(roles_path, name)
+			if os.path.exists(target):
+				if version and get_installed_version(target) == version:
+					continue
+				shutil.rmtree(target)
+			shutil.copytree(path, target, symlinks = True)
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors = True)
 
 def on_clean(filename, targets):
 	# given a requirements file, remove each requirement:
-	with open("requirements.yml", "r") as fp:
-		requirements = yaml.load(fp)
-	for req in requirements:
-		yield cat("ansible-galaxy", "remove", req["name"])
 	roles_path = get_roles_path()
+	if os.path.exists("requirements.yml"):
+		paths = [os.path.join(roles_path, name) for _, _, name in load_requirements("requirements.yml")]
+		for path in filter(os.path.exists, paths): # in-process, the cached copies are kept
+			yield "@remove", path, "required role"
 	if roles_path and os.path.exists(roles_path) and os.listdir(roles_path) == []:
 		os.rmdir(roles_path)
 
+def is_playbook(path):
+	"return True if the YAML file $path is a list of plays, or cannot be parsed at all"
+	try:
+		with open(path, "r") as fp:
+			plays = yaml.safe_load(fp)
+	except yaml.YAMLError: # let the syntax check report it
+		return True
+	return isinstance(plays, list) and bool(plays) and all(isinstance(play, dict)
+		and any(key in play for key in ("hosts", "import_playbook", "include")) for play in plays)
+
+def get_playbooks(roles_path):
+	"return the paths of all the playbooks of the project"
+	paths = []
+	for dirname, dirnames, filenames in os.walk("."):
+		dirnames[:] = sorted(name for name in dirnames
+			if not name.startswith(".")
+			and name not in PRUNED_DIRNAMES
+			and os.path.normpath(os.path.join(dirname, name)) != os.path.normpath(roles_path))
+		for name in sorted(filenames):
+			path = os.path.normpath(os.path.join(dirname, name))
+			if name.endswith((".yml", ".yaml")) and name != "requirements.yml" and is_playbook(path):
+				paths.append(path)
+	return paths
+
+def get_references(path, data):
+	"return the (files, roles) referenced by the YAML $data loaded from $path"
+	files = set()
+	roles = set()
+	def _walk(node):
+		if isinstance(node, dict):
+			for key, value in node.items():
+				if key in INCLUDE_KEYS:
+					for value in value if isinstance(value, list) else [value]:
+						if isinstance(value, basestring) and "{{" not in value: # not templated
+							files.add(os.path.normpath(os.path.join(os.path.dirname(path), value.split()[0])))
+				elif key in INCLUDE_ROLE_KEYS and isinstance(value, dict) and value.get("name"):
+					roles.add(value["name"])
+				elif key in ("roles", "dependencies") and isinstance(value, list): # plays, role meta
+					for role in value:
+						role = role.get("role", role.get("name")) if isinstance(role, dict) else role
+						if isinstance(role, basestring):
+							roles.add(role)
+				_walk(value)
+		elif isinstance(node, list):
+			for item in node:
+				_walk(item)
+	_walk(data)
+	return files, roles
+
+def get_fingerprint(playbook, roles_path, cache):
+	"""
+	Hash the $playbook with the files it includes and the roles it uses, recursively.
+	$cache holds {path: (digest, files, roles)}, shared across playbooks.
+	"""
+	digest = hashlib.sha1()
+	pending = ["ansible.cfg", playbook]
+	seen = set()
+	while pending:
+		path = pending.pop(0)
+		if path in seen:
+			continue
+		seen.add(path)
+		if path not in cache:
+			if os.path.isdir(path): # role
+				cache[path] = ("dir", set(os.path.join(dirname, name)
+					for dirname, _, filenames in os.walk(path)
+						for name in filenames), set())
+			elif os.path.exists(path):
+				with open(path, "rb") as fp:
+					text = fp.read()
+				files, roles = set(), set()
+				if path.endswith((".yml", ".yaml")):
+					try:
+						files, roles = get_references(path, yaml.safe_load(text))
+					except yaml.YAMLError:
+						pass
+				cache[path] = (hashlib.sha1(text).hexdigest(), files, roles)
+			else:
+				cache[path] = ("missing", set(), set())
+		value, files, roles = cache[path]
+		digest.update("%s %s\n" % (path, value))
+		pending += sorted(files)
+		for name in sorted(roles): # resolved as ansible does: next to the playbook, then in the roles path
+			dirnames = [os.path.normpath(os.path.join(dirname, name))
+				for dirname in (os.path.join(os.path.dirname(playbook), "roles"), roles_path)]
+			pending.append(([dirname for dirname in dirnames if os.path.isdir(dirname)] or dirnames)[0])
+	return digest.hexdigest()
+
 def on_run(filename, targets, entrypointid):
 	yield cat("ansible-playbook", filename)
 
 def on_test(filename, targets):
-	yield cat("ansible-playbook", "--syntax-check", filename)
+	"syntax-check all the playbooks concurrently, but those unchanged since their last successful check"
+	roles_path = get_roles_path()
+	cache = {}
+	fingerprints = {}
+	for path in set(get_playbooks(roles_path) + [os.path.normpath(filename)]):
+		fingerprints[path] = get_fingerprint(path, roles_path, cache)
+	state = buildstack.load_json(STATE_PATH)
+	checked = state.get("checked", {})
+	paths = sorted(path for path in fingerprints if checked.get(path) != fingerprints[path])
+	if len(paths) < len(fingerprints):
+		yield "@trace", "%i playbook(s) unchanged since their last check" % (len(fingerprints) - len(paths))
+	try:
+		if len(paths) > 1:
+			yield ("@parallel",) + tuple((path, cat("ansible-playbook", "--syntax-check", path)) for path in paths)
+		elif paths:
+			yield cat("ansible-playbook", "--syntax-check", paths[0])
+	except buildstack.Error as exc:
+		# keep the playbooks which passed, only the others are checked again
+		returncodes = getattr(exc, "returncodes", {})
+		state["checked"] = {path: fingerprints[path] for path in fingerprints
+			if path not in paths or returncodes.get(path) == 0}
+		buildstack.save_json(STATE_PATH, state)
+		raise
+	state["checked"] = fingerprints
+	buildstack.save_json(STATE_PATH, state)
 
 MANIFEST = {
 	"filenames": ("playbook.yml", "*.yml"),
+	"requirements": ("requirements.yml",),
 	"on_get": on_get,
 	"on_clean": on_clean,
 	"on_compile": None,
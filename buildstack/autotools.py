@@ -1,34 +1,116 @@
 # copyright (c) 2015 fclaerhout.fr, released under the MIT license.
 
-import os
+import platform, hashlib, os
+
+import buildstack # core helpers, looked up at call time
 
 cat = lambda *args: args
 
-def on_clean(filename, targets):
-	targets.append("clean")
-	yield "@flush",
-	for name in ("ABOUT-GNU", "INSTALL", "config.rpath", "ltconfig",
-		"ABOUT-NLS", "NEWS", "config.sub", "ltmain.sh", "AUTHORS", "README",
-		"depcomp", "mdat-sh", "BACKLOG", "THANKS", "install-sh", "missing",
-		"COPYING", "TODO", "libversion.in", "mkinstalldirs", "COPYING.DOC",
-		"ar-lib", "ltcf-c.sh", "py-compile", "COPYING.LESSER", "compile",
-		"ltcf-cxx.sh", "texinfo.tex", "COPYING.LIB", "config.guess",
-		"ltcf-gcj.sh", "ylwrap", "Changelog"): # list from 'man automake'
-		if os.path.islink(name):
-			yield "@remove", name, "lingering from automake --add-missing"
-	for name in ("aclocal.m4", "config.h.in","configure", "Makefile.in", "test-driver"):
-		if os.path.exists(name):
-			yield "@remove", name, "lingering from autotools"
-	if filename != "Makefile" and os.path.exists("Makefile"):
-		yield "@remove", "Makefile", "lingering from autotools"
+STATE_PATH = ".buildstack/autotools.json" # fingerprint of the last successful bootstrap, configure cache in use
+
+BUILD_PATH = ".buildstack/build" # VPATH build directories, per profile
+
+CACHE_PATH = os.path.expanduser("~/.buildstack/autotools") # configure caches, per host
+
+BOOTSTRAP_FILENAMES = ("configure.ac", "configure.in", "Makefile.am", "acinclude.m4")
+
+PRECIOUS_VARS = ("CC", "CFLAGS", "CPP", "CPPFLAGS", "CXX", "CXXFLAGS", "LDFLAGS", "LIBS") # checked by configure against its cache
+
+def get_build_dir():
+	"return the build directory of the current buildstack profile"
+	return os.path.join(BUILD_PATH, os.environ.get("BUILDSTACK_PROFILE") or "default")
+
+def get_fingerprint():
+	"hash the autotools inputs of the project: configure.ac, Makefile.am files and local macros"
+	digest = hashlib.sha1()
+	for dirname, dirnames, filenames in os.walk("."):
+		dirnames[:] = sorted(name for name in dirnames if not name.startswith("."))
+		for name in sorted(filenames):
+			if name in BOOTSTRAP_FILENAMES or (name.endswith(".m4") and os.path.basename(dirname) == "m4"):
+				path = os.path.join(dirname, name)
+				digest.update(path)
+				with open(path, "rb") as fp:
+					digest.update(fp.read())
+	return digest.hexdigest()
+
+def get_cache_file():
+	"return the configure cache shared by the builds of this host and compiler settings"
+	digest = hashlib.sha1(repr(platform.uname()))
+	for key in PRECIOUS_VARS:
+		digest.update("%s=%s\n" % (key, os.environ.get(key, "")))
+	return os.path.join(CACHE_PATH, "config.cache.%s" % digest.hexdigest()[:12])
+
+def make(filename, builddir, args):
+	"run make $args, bootstrapping and configuring the $builddir VPATH build first if needed"
+	if args and builddir:
+		state = buildstack.load_json(STATE_PATH)
+		fingerprint = get_fingerprint()
+		# bootstrap only if configure.ac, a Makefile.am or a local macro changed since the last bootstrap
+		if state.get("fingerprint") != fingerprint\
+		or not os.path.exists("configure")\
+		or (os.path.exists("Makefile.am") and not os.path.exists("Makefile.in")):
+			state.pop("fingerprint", None)
+			buildstack.save_json(STATE_PATH, state)
+			# Bootstrap method; generate Makefile with autotools:
+			# REF: https://www.sourceware.org/autobook/autobook/autobook_43.html
+			# TL;DR: don't use autoreconf.
+			yield "libtoolize", # => ltmain.sh (to do before aclocal and automake)
+			yield "aclocal", # configure.xx => aclocal.m4
+			yield "autoconf", # configure.xx => configure
+			with open(filename, "r") as fp:
+				text = fp.read()
+				for key in ("AC_CONFIG_HEADERS", "AM_CONFIG_HEADER"): # AM_CONFIG_HEADER is deprecated
+					if ("\n%s" % key) in text or text.startswith(key):
+						yield "autoheader", # configure.xx => config.h.in
+						break
+				else:
+					yield "@trace", "no AC_CONFIG_HEADERS, skipping autoheader"
+			if os.path.exists("Makefile.am"):
+				# you'll also need AM_INIT_AUTOMAKE() in configure.xx
+				yield "automake", "--add-missing" # configure.xx + Makefile.am => Makefile.in + missing files
+			bootstrapped = True
+		else:
+			bootstrapped = False
+		if bootstrapped or not os.path.exists(os.path.join(builddir, "Makefile")):
+			if os.path.exists("config.status"): # configured in-source, which VPATH builds refuse
+				yield "@trace", "source tree configured in-source, cleaning it with make distclean"
+				yield "make", "distclean"
+			if not os.path.exists(builddir):
+				os.makedirs(builddir)
+			# the results of the configure tests are reused across projects built on this host
+			cache_file = get_cache_file()
+			if not os.path.exists(CACHE_PATH):
+				os.makedirs(CACHE_PATH)
+			if state.get("configuring") and os.path.exists(state["configuring"]):
+				os.remove(state["configuring"]) # left by a failed attempt, may be stale or inconsistent
+			state["configuring"] = cache_file
+			buildstack.save_json(STATE_PATH, state)
+			yield "sh", "-c", "cd \"$0\" && exec \"$@\"", builddir,\
+				os.path.join(os.path.relpath(".", builddir), "configure"),\
+				"--cache-file=%s" % cache_file # system state [+ Makefile.in?] => Makefile
+			state.pop("configuring")
+		state["fingerprint"] = fingerprint
+		buildstack.save_json(STATE_PATH, state)
+	if args:
+		# make joins the buildstack jobserver through MAKEFLAGS, its job count follows the jobs budget
+		yield cat("make", *((["-C", builddir] if builddir else []) + args))
 
 def on_flush(filename, targets):
 	# Invoke Make standard targets:
 	# REF: http://www.gnu.org/prep/standards/html_node/Standard-Targets.html
+	# Projects with a configure script are built out of tree (VPATH), in a build directory per profile:
+	# REF: https://www.gnu.org/software/automake/manual/html_node/VPATH-Builds.html
+	builddir = get_build_dir() if filename != "Makefile" else None
 	args = []
 	while targets:
 		target = targets.pop(0)
-		if target == "clean":
+		if target == "clean" and builddir:
+			for res in make(filename, builddir, args): # the targets requested before
+				yield res
+			args = []
+			if os.path.exists(builddir): # all the files generated by configure and make
+				yield "@remove", builddir
+		elif target == "clean":
 			# clean: delete files generated by make
 			# distclean: delete files generated by configure
 			# maintainer-clean: delete most files generated by autotools
@@ -45,32 +127,13 @@ def on_flush(filename, targets):
 			args.append("uninstall")
 		else:
 			yield "%s: unexpected target" % target
-	if args:
-		if not os.path.exists("Makefile"):
-			# Bootstrap method; generate Makefile with autotools:
-			# REF: https://www.sourceware.org/autobook/autobook/autobook_43.html
-			# TL;DR: don't use autoreconf.
-			yield "libtoolize", # => ltmain.sh (to do before aclocal and automake)
-			yield "aclocal", # configure.xx => aclocal.m4
-			yield "autoconf", # configure.xx => configure
-			with open(filename, "r") as fp:
-				text = fp.read()
-				for key in ("AC_CONFIG_HEADERS", "AM_CONFIG_HEADER"): # AM_CONFIG_HEADER is deprecated
-					if ("\n%s" % key) in text or text.startswith(key):
-						yield "autoheader", # configure.xx => config.h.in
-						break
-				else:
-					yield "@trace", "no AC_CONFIG_HEADERS, skipping autoheader"
-			if os.path.exists("Makefile.am"):
-				# you'll also need AM_INIT_AUTOMAKE() in configure.xx
-				yield "automake", "--add-missing" # configure.xx + Makefile.am => Makefile.in + missing files
-			yield "./configure", # system state [+ Makefile.in?] => Makefile
-		yield cat("make", *args)
+	for res in make(filename, builddir, args):
+		yield res
 
 MANIFEST = {
 	"filenames": ("configure.ac", "configure.in", "Makefile"),
 	"on_get": Exception, # there's no package manager for autotools
-	"on_clean": on_clean,
+	#"on_clean" -> flush
 	#"on_compile" -> flush
 	"on_run": Exception,
 	#"on_test" -> flush
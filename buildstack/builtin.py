@@ -26,7 +26,9 @@ Manifest Syntax:
     - 'reset': use previous phase output paths only
   Test attributes and tags:
   - 'dep@': tagged path is a test dependency
-  - 'mode': 'failfast', run all tests otherwise
+  - 'mode': 'failfast', run all tests otherwise (see also --fail-fast)
+  Previous failures are run first; the status and duration of each test
+  are kept in .buildstack/tests.json.
   Compile attributes and tags:
   - 'main@': tagged path contains the entry point
   - 'res@': tagged path is a resource artifact
@@ -81,7 +83,9 @@ Development 101:
   A Target subclass must implement, at least, the build() method.
 """
 
-import ConfigParser, subprocess, tempfile, shutil, urllib, stat, abc, md5, os
+import ConfigParser, subprocess, threading, testrunner, tempfile, unittest, tarfile, hashlib, shutil, urllib, types, errno, stat, json, time, abc, md5, sys, os
+
+import buildstack # core helpers, looked up at call time
 
 #############
 # templates #
@@ -201,10 +205,10 @@ def _exec(cmd, *args, **kwargs):
 	shell = kwargs.get("shell", False)
 	if not shell:
 		if WINDOWS:
-			if not subprocess.call(("where", cmd), stdout = DEVNULL):
+			if subprocess.call(("where", cmd), stdout = DEVNULL):
 				raise IOError("%s: not installed" % cmd)
 		elif UNIX:
-			if not subprocess.call(("which", cmd), stdout = DEVNULL):
+			if subprocess.call(("which", cmd), stdout = DEVNULL):
 				raise IOError("%s: not installed" % cmd)
 		else:
 			raise NotImplementedError("unsupported platform")
@@ -212,6 +216,43 @@ def _exec(cmd, *args, **kwargs):
 	#print "executing:", args
 	return subprocess.check_output(args, **kwargs)
 
+def reflink(src, dst):
+	"clone $src into $dst sharing its extents (copy-on-write), return False if unsupported"
+	try:
+		import fcntl
+	except ImportError:
+		return False
+	FICLONE = 0x40049409 # linux ioctl, supported by btrfs, xfs and overlayfs
+	with open(src, "rb") as ifp:
+		with open(dst, "wb") as ofp:
+			try:
+				fcntl.ioctl(ofp.fileno(), FICLONE, ifp.fileno())
+			except IOError:
+				ok = False
+			else:
+				ok = True
+	if ok:
+		shutil.copystat(src, dst) # as the shutil.copy2 fallbacks
+	else:
+		os.remove(dst)
+	return ok
+
+def _ar_write(fp, name, write):
+	"""
+	Append an ar member to $fp, its content being streamed by write(fp).
+	The member size is unknown until $write returns: it is patched in the header afterwards.
+	"""
+	assert len(name) <= 16, "%s: ar member name too long" % name
+	offset = fp.tell()
+	fp.write("%-16s%-12i%-6i%-6i%-8s%-10i`\n" % (name, int(time.time()), 0, 0, "100644", 0))
+	write(fp)
+	size = fp.tell() - offset - 60
+	fp.seek(offset + 48)
+	fp.write("%-10i" % size)
+	fp.seek(0, os.SEEK_END)
+	if size % 2:
+		fp.write("\n") # members are 2-byte aligned
+
 class Node(object):
 	"abstract filesystem node"
 
@@ -286,6 +327,29 @@ class File(Node):
 		shutil.copy(path, self.path)
 		return self
 
+	def link_from(self, path):
+		"hardlink $path, fallback on reflink then on copy if not on the same filesystem"
+		self.parent.create()
+		if os.path.lexists(self.path):
+			os.remove(self.path) # a stale link would still point to the old inode
+		try:
+			os.link(path, self.path)
+		except (OSError, AttributeError) as exc:
+			if getattr(exc, "errno", None) not in (None, errno.EXDEV, errno.EPERM, errno.EMLINK):
+				raise
+			if not reflink(path, self.path):
+				shutil.copy2(path, self.path)
+		return self
+
+	def clone_from(self, path):
+		"reflink $path, fallback on copy: unlike a hardlink, an in-place edit of either file leaves the other intact"
+		self.parent.create()
+		if os.path.lexists(self.path):
+			os.remove(self.path)
+		if not reflink(path, self.path):
+			shutil.copy2(path, self.path)
+		return self
+
 	def zip_from(self, *paths):
 		self.parent.create()
 		if UNIX:
@@ -303,11 +367,25 @@ class File(Node):
 		return self
 
 	def deb_from(self, path):
+		"write debian archive from $path/DEBIAN (control) and $path (data), owned by root"
 		self.parent.create()
-		if DEBIAN or UBUNTU:
-			_exec("fakeroot", "dpkg-deb", "--build", path, self.path)
-		else:
-			raise NotImplementedError("unsupported platform")
+		def as_root(tarinfo):
+			if tarinfo.name in ("./DEBIAN", "DEBIAN") or tarinfo.name.startswith("./DEBIAN/"):
+				return None # not part of the data archive
+			tarinfo.uid = tarinfo.gid = 0
+			tarinfo.uname = tarinfo.gname = "root"
+			return tarinfo
+		with open(self.path, "wb") as fp:
+			fp.write("!<arch>\n")
+			_ar_write(fp, "debian-binary", lambda fp: fp.write("2.0\n"))
+			def write_control(fp):
+				with tarfile.open(fileobj = fp, mode = "w:gz") as tar:
+					tar.add(os.path.join(path, "DEBIAN"), arcname = ".", filter = as_root)
+			_ar_write(fp, "control.tar.gz", write_control)
+			def write_data(fp):
+				with tarfile.open(fileobj = fp, mode = "w:gz") as tar:
+					tar.add(path, arcname = ".", filter = as_root)
+			_ar_write(fp, "data.tar.gz", write_data)
 		return self
 
 	def jar_from(self, path, entry):
@@ -436,6 +514,16 @@ class Clean(Target):
 	def build(self, *paths):
 		self.root.delete()
 
+HISTORY_PATH = ".buildstack/tests.json" # status and duration of each test at last run
+
+def iter_tests(suite):
+	for test in suite:
+		if isinstance(test, unittest.TestSuite):
+			for test in iter_tests(test):
+				yield test
+		else:
+			yield test
+
 class _Test(Target):
 
 	def run_python_tests(self, *paths):
@@ -452,8 +540,17 @@ class _Test(Target):
 				mods.append(types.ModuleType(rootname))
 				exec fp.read() in mods[-1].__dict__
 				suite.addTests(unittest.defaultTestLoader.loadTestsFromModule(mods[-1]))
+		history = buildstack.load_json(HISTORY_PATH)
+		failed = lambda test: history.get(test.id(), {}).get("status") in ("failure", "error")
+		suite = unittest.TestSuite(sorted(iter_tests(suite), key = lambda test: not failed(test))) # stable sort
 		failfast = getattr(self, "mode", "default") == "failfast"
-		assert unittest.TextTestRunner(failfast = failfast, verbosity = 2).run(suite).wasSuccessful(), "test(s) failed"
+		result = unittest.TextTestRunner(failfast = failfast, verbosity = 2, resultclass = testrunner.TimedResult).run(suite)
+		for record in result.records:
+			history[record["id"]] = {"status": record["status"], "duration": record["duration"]}
+		buildstack.save_json(HISTORY_PATH, history)
+		for line in testrunner.report(result.records):
+			print line
+		assert result.wasSuccessful(), "test(s) failed"
 
 	def run_tests(self, *paths):
 		if all(path.endswith(".py") for path in paths):
@@ -579,14 +676,14 @@ class Package(Target):
 				etcdir = pkgdir.Dir("etc").Dir(self.name)
 				etcdir.create()
 				for path in self.conf:
-					shutil.copy(path, etcdir.path)
+					etcdir.File(os.path.basename(path)).link_from(path)
 					del paths[paths.index(path)]
 			else:
 				raise NotImplementedError("conf@ tag not yet unsupported on this platform")
 		bindir = pkgdir.Dir("usr").Dir("local").Dir("bin")
 		bindir.create()
 		for path in paths:
-			shutil.copy(path, bindir.path)
+			bindir.File(os.path.basename(path)).link_from(path)
 		# handle services...
 		if hasattr(self, "services"):
 			services = json.loads(self.services)
@@ -679,6 +776,7 @@ class Uninstall(Target):
 SOURCE_PATH = "source"
 VENDOR_PATH = "vendor"
 TARGET_PATH = "target"
+STORE_PATH = os.path.expanduser("~/.buildstack/store") # shared by all workspaces
 
 def init(root):
 	"generate dummy hello world workspace"
@@ -713,26 +811,114 @@ def init(root):
 		with open("build.ini", "w+") as fp:
 			fp.write("[compile:hello]\npaths: main@source/hello.py\n")
 
-def on_get(filename, targets, repositoryid, requirementid):
-	if ".git" in requirementid:
-		# e.g. git://foo.com/bar.git
-		if requirementid.endswith(".git"):
-			basename = os.path.basename(requirementid)
-			rootname, _ = os.path.splitext(basename)
-			_exec("git", "submodule", "add", requirementid, "%s/%s" % (VENDOR_PATH, rootname))
-		# e.g. git://foo.com/bar.git/source/main.c
+class Store(object):
+	"content-addressed store of fetched requirements, keyed by url+revision or package+version"
+
+	def __init__(self, path = None):
+		self.root = Dir(path or STORE_PATH)
+
+	def _get_key(self, requirementid):
+		"return the requirement store key and whether it always identifies the same content"
+		if ".git" in requirementid:
+			remote = requirementid.split(".git", 1)[0] + ".git"
+			revision = _exec("git", "ls-remote", remote, "HEAD").split()[0]
+			return "%s@%s" % (remote, revision), True
+		elif requirementid.startswith("python:"):
+			return requirementid, "==" in requirementid # unpinned packages may change under the same id
 		else:
-			_, path = requirementid.split(".git/")
-			remote = requirementid.replace(path, "")
-			_exec("git archive --remote=%s HEAD %s | tar -x --strip-components %i -C %s" % (remote, path, path.count("/"), VENDOR_PATH), shell = True)
-	elif requirementid.startswith("python:"):
-		_, package = requirementid.split(":", 1)
-		_exec(
-			"easy_install", "--install-dir", VENDOR_PATH, "--exclude-scripts", "--always-unzip", package,
-			env = {"PYTHONPATH": VENDOR_PATH})
-		_exec("rm", "-f", "%s/easy-install.pth" % VENDOR_PATH, "%s/site.py" % VENDOR_PATH, "%s/site.pyc" % VENDOR_PATH)
+			raise NotImplementedError("%s: unsupported requirementid" % requirementid)
+
+	def _fetch(self, requirementid, path):
+		"fetch $requirementid into $path, return the store key of the fetched content if known"
+		if ".git" in requirementid:
+			remote = requirementid.split(".git", 1)[0] + ".git"
+			_exec("git", "clone", "--quiet", "--depth", "1", remote, path)
+			revision = _exec("git", "rev-parse", "HEAD", cwd = path).strip() # HEAD may have moved since ls-remote
+			shutil.rmtree(os.path.join(path, ".git"))
+			return "%s@%s" % (remote, revision)
+		else:
+			_, package = requirementid.split(":", 1)
+			_exec(
+				"easy_install", "--install-dir", path, "--exclude-scripts", "--always-unzip", package,
+				env = dict(os.environ, PYTHONPATH = path))
+			for basename in ("easy-install.pth", "site.py", "site.pyc"):
+				if os.path.exists(os.path.join(path, basename)):
+					os.remove(os.path.join(path, basename))
+
+	def get(self, requirementid):
+		"return the store directory holding $requirementid and whether it was cached, fetch it on miss"
+		key, pinned = self._get_key(requirementid)
+		entry = self.root.Dir(hashlib.sha1(key).hexdigest())
+		if pinned and entry.exists():
+			return entry.path, True
+		tmpdir = self.root.TempDir()
+		try:
+			key = self._fetch(requirementid, tmpdir.path) or key
+		except:
+			tmpdir.delete()
+			raise
+		entry = self.root.Dir(hashlib.sha1(key).hexdigest())
+		if pinned and entry.exists(): # fetched meanwhile
+			tmpdir.delete()
+			return entry.path, False
+		entry.delete() # outdated, if unpinned
+		try:
+			os.rename(tmpdir.path, entry.path) # atomic, concurrent fetches of the same key may race
+		except OSError:
+			tmpdir.delete()
+		return entry.path, False
+
+def _clone_tree(src, dst):
+	"populate $dst with copies of the $src file or directory, sharing extents where supported"
+	if os.path.isdir(src):
+		for dirname, _, basenames in os.walk(src):
+			d = Dir(os.path.join(dst, os.path.relpath(dirname, src))).create()
+			for basename in basenames:
+				d.File(basename).clone_from(os.path.join(dirname, basename))
+	else:
+		Dir(os.path.dirname(dst) or ".").File(os.path.basename(dst)).clone_from(src)
+
+def get_requirement(store, requirementid):
+	"copy $requirementid from the store into the vendor directory, return True if it was cached"
+	path, cached = store.get(requirementid)
+	if ".git/" in requirementid:
+		# e.g. git://foo.com/bar.git/source/main.c
+		_, subpath = requirementid.split(".git/", 1)
+		_clone_tree(
+			os.path.join(path, subpath),
+			os.path.join(VENDOR_PATH, *subpath.split("/")[subpath.count("/"):]))
+	elif ".git" in requirementid:
+		# e.g. git://foo.com/bar.git
+		rootname, _ = os.path.splitext(os.path.basename(requirementid))
+		_clone_tree(path, os.path.join(VENDOR_PATH, rootname))
 	else:
-		raise NotImplementedError("%s: unsupported requirementid" % requirementid)
+		_clone_tree(path, VENDOR_PATH)
+	return cached
+
+def get_requirements(*requirementids):
+	"fetch requirements concurrently, return the ids of the ones found in the store"
+	store = Store()
+	errors = []
+	cached = []
+	def _get(requirementid):
+		try:
+			if get_requirement(store, requirementid):
+				cached.append(requirementid)
+		except Exception as e:
+			errors.append("%s: %s" % (requirementid, e))
+	threads = [threading.Thread(target = _get, args = (requirementid,)) for requirementid in requirementids]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert not errors, "\n".join(errors)
+	return sorted(cached)
+
+def on_get(filename, targets, requirementid):
+	assert requirementid, "missing requirement id"
+	targets.append("get", requirementid = requirementid) # fetched concurrently on flush
+	return
+	yield # force this function to be a generator
 
 def parse_targets(url, root):
 	"parse manifest and return reified targets"
@@ -770,7 +956,16 @@ def on_flush(filename, targets):
 	Phase("install", model = Install, previous = "package")
 	Phase("check", model = Check, previous = "compile")
 	Phase("uninstall", model = Uninstall)
+	requirementids = [target.requirementid for target in targets if target.name == "get"]
+	if requirementids:
+		for requirementid in get_requirements(*requirementids):
+			yield "@trace", "%s: cached" % requirementid
+		targets[:] = [target for target in targets if target.name != "get"]
 	available_targets = list(parse_targets(filename, root = root))
+	if any(target.failfast for target in targets):
+		for tgt in available_targets:
+			if isinstance(tgt, _Test):
+				tgt.mode = "failfast"
 	while targets:
 		target = targets.pop(0)
 		phase, _, name = target.name.partition(":")
@@ -2,41 +2,220 @@
 
 # REF: http://doc.crates.io
 
+import distutils.spawn, hashlib, glob, time, os, re
+
+import buildstack # core helpers, looked up at call time
+
 cat = lambda *args: args
 
+TARGET_PATH = os.path.expanduser("~/.buildstack/cargo") # target directories, shared by sibling workspaces on opt-in
+
+BENCH_PATH = ".buildstack/bench.json" # results of the previous benchmark runs
+
+BENCH_HISTORY = 20 # results kept per benchmark
+
+def get_workspace_root():
+	"return the directory of the nearest manifest declaring a [workspace], the current directory otherwise"
+	dirname = os.getcwd()
+	while True:
+		path = os.path.join(dirname, "Cargo.toml")
+		if os.path.exists(path) and "workspace" in get_sections(path):
+			return dirname
+		if os.path.dirname(dirname) == dirname:
+			return os.getcwd()
+		dirname = os.path.dirname(dirname)
+
+def is_target_sharing_requested(root):
+	"return True if the manifest of $root opts into a shared target directory, i.e. shared-target = true in [workspace|package.metadata.buildstack]"
+	sections = get_sections(os.path.join(root, "Cargo.toml"))
+	return any(re.search(r"^\s*shared-target\s*=\s*true\s*$", sections.get("%s.metadata.buildstack" % key, ""), re.M)
+		for key in ("workspace", "package"))
+
+def get_target_dir():
+	"return the target directory shared by the sibling workspaces, or None to keep the one of cargo"
+	root = get_workspace_root()
+	if "%s%s%s" % (os.sep, os.path.normpath(buildstack.MATRIX_PATH), os.sep) in os.getcwd() + os.sep: # clones of a same workspace
+		return None
+	elif is_target_sharing_requested(root):
+		return os.path.join(TARGET_PATH, hashlib.sha1(os.path.dirname(root)).hexdigest()[:12])
+
+def get_package_name(filename):
+	"return the [package] name of the manifest $filename, or None for a virtual manifest"
+	with open(filename, "r") as fp:
+		match = re.search(r"^\[package\][^\[]*?^\s*name\s*=\s*\"([^\"]+)\"", fp.read(), re.M | re.S)
+	return match.group(1) if match else None
+
+def get_sections(filename):
+	"return {header: body} of the top-level tables of the manifest $filename"
+	with open(filename, "r") as fp:
+		return dict(re.findall(r"^\[([^\[\]\n]+)\]\s*$(.*?)(?=^\[[^\[\]\n]+\]\s*$|\Z)", fp.read(), re.M | re.S))
+
+def get_workspace_members(filename):
+	"return {name: path} of the packages of the workspace manifest $filename, empty if not a workspace"
+	sections = get_sections(filename)
+	if "workspace" not in sections:
+		return {}
+	def _get_list(key):
+		match = re.search(r"^\s*%s\s*=\s*\[([^\]]*)\]" % key, sections["workspace"], re.M)
+		return re.findall(r"\"([^\"]+)\"", match.group(1)) if match else []
+	excluded = set(os.path.normpath(path) for path in _get_list("exclude"))
+	paths = set(path for pattern in _get_list("members") for path in glob.glob(pattern))
+	if "package" in sections: # root package
+		paths.add(".")
+	members = {}
+	for path in sorted(paths):
+		manifest = os.path.join(path, "Cargo.toml")
+		if os.path.normpath(path) not in excluded and os.path.exists(manifest):
+			name = get_package_name(manifest)
+			if name:
+				members[name] = path
+	return members
+
+def get_dependencies(filename):
+	"return the names of the normal and build dependencies of the manifest $filename"
+	names = set()
+	for header, body in get_sections(filename).items():
+		match = re.match(r"(?:target\..+\.)?(?:build-)?dependencies(?:\.([\w\-]+))?$", header)
+		if match and match.group(1): # [dependencies.<name>]
+			names.add(match.group(1))
+		elif match:
+			names.update(re.findall(r"^\s*([\w\-]+)\s*=", body, re.M))
+	return names
+
+def get_publish_waves(members):
+	"return the lists of $members publishable concurrently, each after the previous ones"
+	dependencies = {}
+	for name, path in members.items():
+		dependencies[name] = get_dependencies(os.path.join(path, "Cargo.toml")) & set(members) - set((name,))
+	waves = []
+	published = set()
+	while len(published) < len(members):
+		wave = sorted(name for name in members if name not in published and dependencies[name] <= published)
+		if not wave:
+			raise ValueError("dependency cycle between %s" % ", ".join(sorted(set(members) - published)))
+		waves.append(wave)
+		published.update(wave)
+	return waves
+
+def get_profile_args(filename):
+	"return the arguments selecting the cargo build profile named after the buildstack profile, if any"
+	profileid = os.environ.get("BUILDSTACK_PROFILE")
+	if profileid == "release":
+		return ["--release"]
+	with open(filename, "r") as fp:
+		if profileid and re.search(r"^\[profile\.%s\]" % re.escape(profileid), fp.read(), re.M): # custom profile
+			return ["--profile", profileid]
+	return []
+
+UNITS = {"ps": .001, "ns": 1, "us": 1000, "\xc2\xb5s": 1000, "ms": 1000000, "s": 1000000000}
+
+def parse_bench(lines):
+	"return {name: ns/iter} from the libtest or criterion benchmark output $lines"
+	results = {}
+	for line in lines:
+		match = re.match(r"test (\S+) +\.\.\. bench: +([\d,]+) ns/iter", line)
+		if match: # libtest
+			results[match.group(1)] = float(match.group(2).replace(",", ""))
+			continue
+		match = re.match(r"(\S.*?) +time: +\[\S+ \S+ (\S+) (\S+) ", line)
+		if match and match.group(3) in UNITS: # criterion, median estimate
+			results[match.group(1)] = float(match.group(2)) * UNITS[match.group(3)]
+	return results
+
+def run_bench(filename):
+	"run the benchmarks, record their results and compare them with the previous run"
+	output = yield "@output", "cargo", "bench"
+	results = buildstack.load_json(BENCH_PATH)
+	now = time.time()
+	values = parse_bench(output.splitlines())
+	if not values: # e.g. unsupported harness, show its output as is
+		yield "@echo", output.rstrip()
+	for name, value in sorted(values.items()):
+		history = results.setdefault(name, [])
+		if history:
+			yield "@echo", "%s: %.0f ns/iter (%+.1f%%)" % (name, value, 100. * (value - history[-1][1]) / history[-1][1])
+		else:
+			yield "@echo", "%s: %.0f ns/iter" % (name, value)
+		history.append((now, value))
+		del history[:-BENCH_HISTORY]
+	buildstack.save_json(BENCH_PATH, results)
+
+def on_bench(filename, targets):
+	targets.append("bench")
+	return
+	yield # force this function to be a generator
+
 def on_flush(filename, targets):
-	args = []
+	# on opt-in, dependencies are compiled once for all sibling workspaces, unless the target directory is set by the user
+	target_dir = get_target_dir()
+	if target_dir:
+		os.environ.setdefault("CARGO_TARGET_DIR", target_dir)
+	# cache compilations across target directories and clean builds, if sccache is installed
+	if "RUSTC_WRAPPER" not in os.environ and distutils.spawn.find_executable("sccache"):
+		os.environ["RUSTC_WRAPPER"] = "sccache"
+	profile = get_profile_args(filename) # shared by all commands, so that nothing is built twice
+	workspace = get_workspace_members(filename)
+	members = workspace if len(workspace) > 1 else {} # run per package only when there is more than one
+	commands = [] # cargo takes one command at once
+	bench = False
 	while targets:
 		target = targets.pop(0)
 		if target == "get":
-			args.append("update")
+			commands.append(cat("cargo", "update"))
 			if target.requirementid:
-				args += ["-p", target.requirementid]
+				commands[-1] += ("-p", target.requirementid)
 		elif target == "clean":
-			args.append("clean")
+			names = sorted(workspace) or filter(None, (get_package_name(filename),))
+			if names: # keep the sibling crates artifacts, should the target directory be shared
+				commands.append(cat("cargo", "clean", *sum((["-p", name] for name in names), [])))
+			else:
+				yield "@trace", "no package to clean"
 		elif target == "compile":
-			args.append("build") # create a profile to append "--release" when needed
+			commands.append(cat("cargo", "build", *profile))
 		elif target == "run":
-			args.append("run")
+			commands.append(cat("cargo", "run", *profile))
+		elif target == "test" and members:
+			# compile all the test binaries at once, then run them per package: cargo releases its lock to run them
+			commands.append(cat("cargo", "test", "--workspace", "--no-run", *profile))
+			commands.append(("@parallel",) + tuple((name, cat("cargo", "test", "-p", name, *profile)) for name in sorted(members)))
 		elif target == "test":
-			args.append("test")
-			args.append("bench")
-		elif target == "package":
-			args.append("package")
-		elif target == "publish":
-			args.append("publish")
+			commands.append(cat("cargo", "test", *profile))
+		elif target == "bench":
+			bench = True
+		elif target in ("package", "publish"):
+			# verified from the target directory, reusing the dependencies built above
+			if not members:
+				commands.append(cat("cargo", target.name))
+			elif target == "package":
+				commands.append(("@parallel",) + tuple((name, cat("cargo", "package", "-p", name)) for name in sorted(members)))
+			else:
+				try:
+					waves = get_publish_waves(members)
+				except ValueError as exc:
+					yield "%s" % exc
+					return
+				for wave in waves: # a package is published once its workspace dependencies are
+					if len(wave) > 1:
+						commands.append(("@parallel",) + tuple((name, cat("cargo", "publish", "-p", name)) for name in wave))
+					else:
+						commands.append(cat("cargo", "publish", "-p", wave[0]))
 		else:
 			yield "%s: unexpected target" % target
-	if args:
-		yield cat("cargo", *args)
+	for res in commands:
+		yield res
+	if bench:
+		for res in run_bench(filename):
+			yield res
 
 MANIFEST = {
 	"filenames": ("Cargo.toml",),
+	"requirements": ("Cargo.toml", "Cargo.lock"),
 	#"on_get" -> flush
 	#"on_clean" -> flush
 	#"on_compile" -> flush
 	#"on_run" -> flush
 	#"on_test" -> flush
+	"on_bench": on_bench,
 	"on_release": Exception,
 	#"on_package" -> flush
 	#"on_publish" -> flush
@@ -1,19 +1,70 @@
 # copyright (c) 2015 fclaerhout.fr, released under the MIT license.
 
+import xml.etree.ElementTree as ET, fnmatch, hashlib, os
+
+import buildstack # core helpers, looked up at call time
+
 cat = lambda *args: args
 
-def on_flush(filename, targets):
+STATE_PATH = ".buildstack/maven.json" # revision and pom fingerprint of the last successful build, per goal
+
+LOCAL_REPOSITORY_PATH = os.path.expanduser("~/.m2/repository")
+
+ONLINE_GOALS = ("deploy",)
+
+SELECTIVE_GOALS = ("compile", "test", "package") # outputs kept in the module target directories
+
+ARTIFACT_THREADS = 16 # concurrent artifact downloads
+
+IGNORED_PATTERNS = ("*.md", "*.rst", "*.txt", ".gitignore", ".hgignore") # outside of modules
+
+def get_modules(filename, dirname = ""):
+	"return the paths of the reactor modules declared by the pom $filename, recursively"
+	modules = []
+	root = ET.parse(filename).getroot()
+	ns = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+	for module in root.findall("%smodules/%smodule" % (ns, ns)):
+		path = os.path.normpath(os.path.join(dirname, module.text.strip()))
+		modules.append(path)
+		if os.path.exists(os.path.join(path, "pom.xml")):
+			modules += get_modules(os.path.join(path, "pom.xml"), path)
+	return modules
+
+def get_fingerprint(filename, modules):
+	"hash the poms of the reactor"
+	digest = hashlib.sha1()
+	for path in [filename] + [os.path.join(module, "pom.xml") for module in modules]:
+		if os.path.exists(path):
+			with open(path, "rb") as fp:
+				digest.update(fp.read())
+	return digest.hexdigest()
+
+def get_changed_modules(modules, changes):
+	"return the modules owning the changed paths, or None if a change may impact all modules"
+	changed = set()
+	for path in map(os.path.normpath, changes):
+		owners = [module for module in modules if path.startswith(module + os.sep)]
+		if owners:
+			changed.add(max(owners, key = len)) # innermost module
+		elif not any(fnmatch.fnmatch(path, pattern) for pattern in IGNORED_PATTERNS):
+			return None # e.g. parent pom
+	return sorted(changed)
+
+def on_get(filename, targets, requirementid):
+	targets.append("get", requirementid = requirementid) # run on flush, concurrently with clean
+	return
+	yield # force this function to be a generator
+
+def on_flush(filename, targets, vcs):
 	args = []
+	gets = []
 	while targets:
 		target = targets.pop(0)
 		if target == "get":
-			# EXPERIMENTAL
-			if not target.requirementid:
-				yield "oops, unable yet to get all dependencies"
+			if target.requirementid: # groupId:artifactId:version
+				gets.append((target.requirementid, ("dependency:get", "--define", "artifact=%s" % target.requirementid)))
 			else:
-				args += ["org.apache.maven.plugins:maven-dependency-plugin:2.1:get", "--define", "artifact=%s" % requirementid]
-			if repositoryid:
-				args += ["--define", "repoUrl=%s" % repositoryid]
+				gets.append(("get", ("dependency:go-offline",)))
 		elif target == "clean":
 			args.append("clean")
 		elif target == "compile":
@@ -28,12 +79,65 @@ def on_flush(filename, targets):
 			args.append("install")
 		else:
 			yield "%s: unexpected target" % target
+	state = buildstack.load_json(STATE_PATH)
+	revisions = state.setdefault("revisions", {})
+	fingerprints = state.setdefault("fingerprints", {})
+	if "clean" in args:
+		revisions.clear() # the outputs of all goals are about to be removed
+		buildstack.save_json(STATE_PATH, state)
+	if gets:
+		# fill the local repository, downloading artifacts concurrently, while cleaning
+		jobs = [(label, cat("mvn", "--define", "maven.artifact.threads=%i" % ARTIFACT_THREADS, "--file", filename, *goals))
+			for label, goals in gets]
+		if args[:1] == ["clean"]:
+			jobs.append(("clean", cat("mvn", "--file", filename, args.pop(0))))
+		if len(jobs) > 1:
+			yield ("@parallel",) + tuple(jobs)
+		else:
+			yield jobs[0][1]
 	if args:
-		yield cat("mvn", "--update-snapshots", "--file", filename, *args)
+		goals = [arg for arg in args if arg != "clean"]
+		modules = get_modules(filename)
+		fingerprint = get_fingerprint(filename, modules)
+		# build the modules changed since the last successful build of each goal, and their dependents;
+		# goals installing or deploying artifacts always run on the whole reactor
+		revision = vcs.get_revision()
+		if revision and goals and all(goal in SELECTIVE_GOALS and revisions.get(goal) for goal in goals):
+			changed = set()
+			for since in set(revisions[goal] for goal in goals):
+				changes = vcs.get_changes(since)
+				owners = get_changed_modules(modules, changes) if changes is not None else None
+				if owners is None:
+					changed = None
+					break
+				changed.update(owners)
+			if changed == set():
+				yield "@trace", "reactor up-to-date since %s" % min(revisions[goal][:12] for goal in goals)
+				return
+			elif changed:
+				args = ["--projects", ",".join(sorted(changed)), "--also-make-dependents"] + args
+		# the local repository is warm if the same goals succeeded with the same poms: skip remote checks
+		if goals and all(fingerprints.get(goal) == fingerprint for goal in goals)\
+		and os.path.exists(LOCAL_REPOSITORY_PATH)\
+		and not any(goal in args for goal in ONLINE_GOALS):
+			options = ["--offline"]
+		else:
+			options = ["--update-snapshots"]
+		# forget the goals until they succeed, e.g. a plugin missing offline: check remotes next time
+		for goal in goals:
+			fingerprints.pop(goal, None)
+		buildstack.save_json(STATE_PATH, state)
+		yield cat("mvn", *(options + ["--file", filename] + args))
+		for goal in goals:
+			fingerprints[goal] = fingerprint
+			if revision:
+				revisions[goal] = revision
+		buildstack.save_json(STATE_PATH, state)
 
 MANIFEST = {
 	"filenames": ("pom.xml",),
-	#"on_get" -> flush
+	"requirements": ("pom.xml",),
+	"on_get": on_get,
 	#"on_clean" -> flush
 	#"on_compile" -> flush
 	"on_run": Exception,
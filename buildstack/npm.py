@@ -25,6 +25,7 @@ def on_publish(filename, targets, repositoryid): yield "npm", "publish"
 
 MANIFEST = {
 	"filenames": ("package.json",),
+	"requirements": ("package.json",),
 	#"on_get": on_get,
 	#"on_clean": None | on_clean,
 	#"on_test": on_test,
@@ -1,60 +1,374 @@
 # copyright (c) 2015 fclaerhout.fr, released under the MIT license.
 
-import shutil, glob, ast, sys, os, re
+import xml.etree.ElementTree as ET, multiprocessing, ConfigParser, subprocess, tempfile, atexit, StringIO, textwrap, heapq, fcntl, shutil, urllib2, fnmatch, hashlib, json, glob, ast, sys, os, re
+
+import buildstack, testrunner # core helpers, looked up at call time
 
 cat = lambda *args: args
 
-def on_get(filename, targets, requirementid = "requirements.txt"):
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testrunner.py")
+
+HISTORY_PATH = ".buildstack/tests.json" # status and duration of each test at last run
+
+IMPACT_PATH = ".buildstack/impact.json" # revision of the last green run
+
+JUNIT_PATH = "junit.xml"
+
+STAMP_NAME = "buildstack-requirements.json" # requirements fingerprints installed, kept in the environment site directory
+
+WHEELHOUSE_PATH = os.path.expanduser("~/.buildstack/wheelhouse") # shared by all workspaces
+
+PYPIRC_PATH = os.path.expanduser("~/.pypirc")
+
+ARCHIVE_FORMATS = ("gztar", "bztar", "xztar", "ztar", "tar", "zip")
+
+# built distributions, accepting --skip-build and --bdist-dir
+BDIST_COMMANDS = {
+	"bdist": ("bdist_dumb",),
+	"wheel": ("bdist_wheel",),
+	"egg": ("bdist_egg",),
+	"wininst": ("bdist_wininst",),
+	"msi": ("bdist_msi",),
+}
+BDIST_COMMANDS.update({"bdist:%s" % fmt: ("bdist_dumb", "--format=%s" % fmt) for fmt in ARCHIVE_FORMATS})
+BDIST_COMMANDS.update({fmt: ("bdist_dumb", "--format=%s" % fmt) for fmt in ARCHIVE_FORMATS})
+
+SDIST_FORMATS = {"sdist": None}
+SDIST_FORMATS.update({"sdist:%s" % fmt: fmt for fmt in ARCHIVE_FORMATS})
+
+FULL_RUN_PERIOD = 10 # partial runs between two full runs, refreshing the coverage maps
+
+FULL_RUN_PATTERNS = ("setup.py", "setup.cfg", "requirements*.txt", "tox.ini")
+
+# setup.py command server, compatible with python 2 and 3:
+# receives json argv lines on fd argv[1], replies exit status lines on fd argv[2].
+DRIVER = """
+import traceback, json, sys, os
+requests, replies = os.fdopen(int(sys.argv[1]), "r"), os.fdopen(int(sys.argv[2]), "w")
+import setuptools, distutils.core # the expensive part, done once
+preloaded = set(sys.modules)
+root = os.path.join(os.getcwd(), "")
+for line in iter(requests.readline, ""):
+	sys.argv = [arg if isinstance(arg, str) else arg.encode("utf-8") for arg in json.loads(line)] # python 2 decodes unicode
+	status = 0
+	try:
+		with open(sys.argv[0]) as fp:
+			code = compile(fp.read(), sys.argv[0], "exec")
+		exec(code, {"__name__": "__main__", "__file__": sys.argv[0]})
+	except SystemExit as exc:
+		if exc.code is None or isinstance(exc.code, int):
+			status = exc.code or 0
+		else:
+			sys.stderr.write("%s\\n" % exc.code)
+			status = 1
+	except BaseException:
+		traceback.print_exc()
+		status = 1
+	sys.stdout.flush()
+	sys.stderr.flush()
+	for name in set(sys.modules) - preloaded: # reload the project modules next time
+		path = getattr(sys.modules[name], "__file__", None)
+		if path and os.path.abspath(path).startswith(root):
+			del sys.modules[name]
+	replies.write("%i\\n" % status)
+	replies.flush()
+"""
+
+class Interpreter(object):
+	"long-lived $python interpreter running setup.py commands from the current directory, setuptools being imported once"
+
+	def __init__(self, python = "python"):
+		server_rfd, client_wfd = os.pipe() # requests
+		client_rfd, server_wfd = os.pipe() # replies
+		for fd in (client_rfd, client_wfd):
+			fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC) # only the server ends are inherited
+		self.proc = subprocess.Popen((python, "-c", DRIVER, str(server_rfd), str(server_wfd)))
+		os.close(server_rfd)
+		os.close(server_wfd)
+		self.requests = os.fdopen(client_wfd, "w")
+		self.replies = os.fdopen(client_rfd, "r")
+		atexit.register(self.close)
+
+	def run(self, *args):
+		"run setup.py commands and return their exit status"
+		self.requests.write("%s\n" % json.dumps(args))
+		self.requests.flush()
+		reply = self.replies.readline()
+		if not reply:
+			raise RuntimeError("setup.py interpreter terminated unexpectedly")
+		return int(reply)
+
+	def close(self):
+		if self.proc.poll() is None:
+			self.requests.close()
+			self.proc.wait()
+
+_interpreters = {} # per (python, directory)
+
+def get_interpreter(python = "python"):
+	key = (python, os.getcwd())
+	if key not in _interpreters or _interpreters[key].proc.poll() is not None:
+		_interpreters[key] = Interpreter(python)
+	return _interpreters[key]
+
+def get_requirements_digest(path, digest = None):
+	"hash the requirements file $path and the requirements and constraints files it includes"
+	digest = digest or hashlib.sha1()
+	with open(path, "r") as fp:
+		text = fp.read()
+	digest.update(text)
+	for match in re.finditer(r"^\s*(?:-r|--requirement|-c|--constraint)[\s=]+(\S+)", text, re.M):
+		get_requirements_digest(os.path.join(os.path.dirname(path), match.group(1)), digest)
+	return digest
+
+def on_get(filename, targets, requirementid = None):
 	yield "@flush",
-	args = ["install"]
-	if os.path.exists(requirementid):
-		# requirements file
-		args += ["--requirement", requirementid]
-	else:
+	requirementid = requirementid or "requirements.txt"
+	if not os.path.exists(requirementid):
 		# single module
-		args += [requirementid]
-	yield cat("pip", *args)
+		yield cat("pip", "install", requirementid)
+		return
+	# requirements file: build the wheels once per requirements set and interpreter, install offline
+	identity = yield "@output", "pip", "--version"
+	match = re.search(r" from (.+) \((python [^)]+)\)", identity) # pip X from SITE/pip (python Y)
+	if not match:
+		yield "%s: unexpected pip --version output" % identity.strip()
+	stamp = os.path.join(os.path.dirname(match.group(1)), STAMP_NAME) # a recreated environment has none
+	digest = get_requirements_digest(requirementid)
+	digest.update(match.group(2))
+	fingerprint = digest.hexdigest()
+	stamps = buildstack.load_json(stamp)
+	if stamps.get(os.path.abspath(requirementid)) == fingerprint:
+		yield "@trace", "requirements up-to-date"
+		return
+	wheelhouse = os.path.join(WHEELHOUSE_PATH, fingerprint)
+	if not os.path.exists(wheelhouse):
+		tmpdir = "%s.%i" % (wheelhouse, os.getpid())
+		try:
+			yield cat("pip", "wheel", "--wheel-dir", tmpdir, "--requirement", requirementid)
+			try:
+				os.rename(tmpdir, wheelhouse) # atomic, only complete wheelhouses are used
+			except OSError:
+				if not os.path.exists(wheelhouse): # not built concurrently
+					raise
+		finally:
+			shutil.rmtree(tmpdir, ignore_errors = True)
+	yield cat("pip", "install", "--no-index", "--find-links", wheelhouse, "--requirement", requirementid)
+	stamps[os.path.abspath(requirementid)] = fingerprint
+	try:
+		buildstack.save_json(stamp, stamps)
+	except (IOError, OSError): # e.g. system environment
+		yield "@trace", "%s: not writable, requirements will be installed again" % stamp
 
 def on_clean(filename, targets):
 	targets.append("clean")
 	yield "@flush",
-	# remove *.pyc and *.pyo files
-	for dirname, _, basenames in os.walk("."):
-		for basename in basenames:
-			_, extname = os.path.splitext(basename)
-			if extname in (".pyc", ".pyo"):
-				path = os.path.join(dirname, basename)
-				yield "@remove", path, "lingering bytecode"
-	# cleanup dist
-	for name in glob.glob("dist") + glob.glob("*.egg-info"):
-		yield "@remove", name, "lingering packaging byproduct"
-	# cleanup requirements
-	for name in glob.glob("*.egg*") + glob.glob(".eggs"):
-		yield "@remove", name, "lingering requirement"
-
-def get_entry_points():
-	with open("setup.py") as fp:
-		t = ast.parse(fp.read())
-		for stmt in t.body:
-			if isinstance(stmt, ast.Expr)\
-			and isinstance(stmt.value, ast.Call)\
-			and stmt.value.func.attr == "setup":
-				for kw in stmt.value.keywords:
-					if kw.arg == "entry_points":
-						return ast.literal_eval(kw.value)
+	yield "@sweep",\
+		"*.pyc", "*.pyo", "__pycache__",\
+		"/dist", "/*.egg-info", "/%s" % JUNIT_PATH,\
+		"/*.egg*", "/.eggs" # requirements
+
+def get_entry_points(filename):
+	"""
+	Return the console and gui scripts as {name: "module:attrs"}, read from the egg-info metadata
+	if up-to-date with $filename, from the literal setup() keyword otherwise.
+	"""
+	sections = {}
+	for path in glob.glob("*.egg-info/entry_points.txt") + glob.glob("*/*.egg-info/entry_points.txt"):
+		if os.path.getmtime(path) >= os.path.getmtime(filename):
+			parser = ConfigParser.RawConfigParser()
+			parser.optionxform = str # case-sensitive names
+			parser.read(path)
+			sections = {section: ["%s = %s" % item for item in parser.items(section)] for section in parser.sections()}
+			break
+	else:
+		sections = get_setup_keyword(filename, "entry_points") or {}
+		if isinstance(sections, str): # ini-style text
+			parser = ConfigParser.RawConfigParser()
+			parser.optionxform = str
+			parser.readfp(StringIO.StringIO(textwrap.dedent(sections)))
+			sections = {section: ["%s = %s" % item for item in parser.items(section)] for section in parser.sections()}
+	entry_points = {}
+	for script_type in ("console_scripts", "gui_scripts"):
+		items = sections.get(script_type, ())
+		if isinstance(items, str):
+			items = items.splitlines()
+		for item in items:
+			if "=" in item:
+				name, tail = item.split("=", 1)
+				entry_points[name.strip()] = tail.split("[", 1)[0].strip() # drop extras
+	return entry_points
 
 def on_run(filename, targets, entrypointid):
-	"run entry points defined in the build manifest"
+	"run entry points defined in the build manifest, all of them concurrently if no id is given"
 	yield "@flush",
-	ep = get_entry_points()
-	for script_type in ("console_scripts", "gui_scripts"):
-		for item in ep.get(script_type, ()):
-			name, tail = item.split("=", 1)
-			mod, func = tail.split(":", 1)
-			if not entrypointid or entrypointid == name:
-				yield "python", "-c", "import %s; %s.%s()" % (mod, mod, func)
+	entry_points = get_entry_points(filename)
+	if entrypointid and entrypointid not in entry_points:
+		yield "%s: no such entry point" % entrypointid
+	commands = []
+	for name in sorted(entry_points):
+		if not entrypointid or entrypointid == name:
+			mod, attrs = entry_points[name].split(":", 1)
+			commands.append((name, ("python", "-c", "import sys, %s; sys.exit(%s.%s())" % (mod, mod, attrs))))
+	if len(commands) > 1:
+		yield ("@parallel",) + tuple(commands)
+	elif commands:
+		yield commands[0][1]
+
+def get_setup_keyword(filename, key):
+	"return the literal value of the setup() keyword $key, or None if unset or not a literal"
+	with open(filename, "r") as fp:
+		t = ast.parse(fp.read(), filename)
+	for node in ast.walk(t):
+		if isinstance(node, ast.Call)\
+		and getattr(node.func, "attr", getattr(node.func, "id", None)) == "setup":
+			for kw in node.keywords:
+				if kw.arg == key:
+					try:
+						return ast.literal_eval(kw.value)
+					except ValueError:
+						return None
+
+def get_changes(vcs, impact):
+	"return the paths changed since the last green run, or None if all tests must run"
+	if not vcs or not impact.get("revision") or impact.get("partial_runs", 0) >= FULL_RUN_PERIOD:
+		return None
+	changes = vcs.get_changes(impact["revision"])
+	if changes is None or any(fnmatch.fnmatch(path, pattern) for path in changes for pattern in FULL_RUN_PATTERNS):
+		return None
+	return changes
+
+def select_tests(testids, history, changes):
+	"return the tests impacted by $changes: new, unmapped, not green at last run or covering a changed file"
+	changes = set(os.path.normpath(path) for path in changes)
+	return [
+		testid for testid in testids
+		if testid not in history
+		or "files" not in history[testid]
+		or history[testid]["status"] != "success"
+		or changes.intersection(history[testid]["files"])]
+
+def shard(testids, durations, count, first = ()):
+	"distribute tests into $count shards of balanced historical durations, tests in $first then longest tests first"
+	default = float(sum(durations.values())) / len(durations) if durations else 1.
+	heap = [(0., i, []) for i in range(count)]
+	for testid in sorted(testids, key = lambda testid: (testid not in first, -durations.get(testid, default))):
+		duration, i, testids = heapq.heappop(heap)
+		testids.append(testid)
+		heapq.heappush(heap, (duration + durations.get(testid, default), i, testids))
+	return [testids for _, _, testids in sorted(heap, key = lambda item: item[1]) if testids]
 
-def on_test(filename, targets):
+def write_junit(records, path):
+	count = lambda status: sum(1 for record in records if record["status"] == status)
+	testsuite = ET.Element("testsuite", {
+		"name": "buildstack",
+		"tests": "%i" % len(records),
+		"failures": "%i" % count("failure"),
+		"errors": "%i" % count("error"),
+		"skipped": "%i" % count("skipped"),
+		"time": "%.3f" % sum(record["duration"] for record in records),
+	})
+	for record in records:
+		classname, _, name = record["id"].rpartition(".")
+		testcase = ET.SubElement(testsuite, "testcase", {
+			"classname": classname,
+			"name": name,
+			"time": "%.3f" % record["duration"],
+		})
+		if record["status"] != "success":
+			ET.SubElement(testcase, record["status"], {"message": (record["message"] or "").strip().split("\n")[-1]}).text = record["message"]
+	ET.ElementTree(testsuite).write(path, encoding = "utf-8")
+
+def get_jobs():
+	"return the jobs budget advertised by the buildstack jobserver"
+	match = re.search(r"(?:^|\s)-j\s*(\d+)", os.environ.get("MAKEFLAGS", ""))
+	return int(match.group(1)) if match else multiprocessing.cpu_count()
+
+def run_tests(suite, count = None, vcs = None, failfast = False):
+	"""
+	Run the test suite sharded across worker processes, previous failures first.
+	If $vcs is set, only run the impacted tests.
+	If $failfast is set, abort all shards on the first failure.
+	The pending targets are flushed beforehand.
+	"""
+	yield "@flush",
+	history = buildstack.load_json(HISTORY_PATH)
+	impact = buildstack.load_json(IMPACT_PATH)
+	revision = vcs.get_revision() if vcs else None
+	changes = get_changes(vcs, impact) if revision else None
+	tmpdir = tempfile.mkdtemp()
+	try:
+		path = os.path.join(tmpdir, "testids.json")
+		yield "python", RUNNER, "discover", suite, path
+		with open(path, "r") as fp:
+			testids = json.load(fp)
+		if not testids:
+			yield "@trace", "no test found"
+			return
+		if changes is not None:
+			yield "@trace", "%i file(s) changed since %s" % (len(changes), impact["revision"][:12])
+			testids = select_tests(testids, history, changes)
+			if not testids:
+				yield "@trace", "no test impacted"
+				return
+		first = set(testid for testid in testids if history.get(testid, {}).get("status") in ("failure", "error"))
+		if first:
+			yield "@trace", "running %i previous failure(s) first" % len(first)
+		shards = shard(
+			testids = testids,
+			durations = {testid: history[testid]["duration"] for testid in history},
+			count = min(count or get_jobs(), len(testids)),
+			first = first)
+		jobs = []
+		for i, testids in enumerate(shards):
+			path = os.path.join(tmpdir, "shard%i.json" % i)
+			with open(path, "w") as fp:
+				json.dump(testids, fp)
+			args = ("python", RUNNER, "run", path, "%s.out" % path)
+			if revision: # record the coverage maps for the next impact analysis
+				args += ("cover",)
+			if failfast:
+				args += ("failfast",)
+			jobs.append(("shard%i" % i, args))
+		try:
+			yield ("@parallel",) + tuple(jobs)
+		except Exception as exc: # keep the partial results, failures are reported below
+			crash = exc
+		else:
+			crash = None
+		records = []
+		for i in range(len(shards)):
+			path = os.path.join(tmpdir, "shard%i.json.out" % i)
+			if os.path.exists(path):
+				with open(path, "r") as fp:
+					records += json.load(fp)
+	finally:
+		shutil.rmtree(tmpdir)
+	write_junit(records, JUNIT_PATH)
+	for record in records:
+		history[record["id"]] = {key: record[key] for key in ("status", "duration", "files") if key in record}
+	buildstack.save_json(HISTORY_PATH, history)
+	for line in testrunner.report(records):
+		yield "@echo", line
+	failed = [record for record in records if record["status"] in ("failure", "error")]
+	yield "@echo", "%i test(s) run in %i shard(s), %i failed" % (len(records), len(shards), len(failed))
+	if crash and not failed:
+		raise crash
+	elif failed:
+		yield "%i test(s) failed, see %s" % (len(failed), JUNIT_PATH)
+	elif revision:
+		buildstack.save_json(IMPACT_PATH, {
+			"revision": revision,
+			"partial_runs": 0 if changes is None else impact.get("partial_runs", 0) + 1,
+		})
+
+def is_sharding_requested():
+	"return True if setup.cfg opts into the sharded test runner, i.e. [buildstack] shard_tests = true"
+	parser = ConfigParser.RawConfigParser()
+	parser.read("setup.cfg")
+	return parser.has_option("buildstack", "shard_tests") and parser.getboolean("buildstack", "shard_tests")
+
+def on_test(filename, targets, vcs, failfast):
 	# if nose2 configuration file exists, use nose2 as test framework
 	text = open(filename).read()
 	if os.path.exists("nose2.cfg") and "nose2.collector.collector" not in text:
@@ -63,43 +377,106 @@ def on_test(filename, targets):
 		text = re.sub("test_suite.*?,", "test_suite = \"nose2.collector.collector\",", text)
 		with open(filename, "w") as f:
 			f.write(text)
-	targets.append("test")
-	# Setuptools BUG?
-	# - "python setup.py sdist test" handles both targets as expected
-	# - "python setup.py test sdist" handles "test" only :-(
-	# solution: flush targets after test
-	yield "@flush",
+	suite = get_setup_keyword(filename, "test_suite")
+	if os.path.exists("nose2.cfg") or not isinstance(suite, str) or not is_sharding_requested():
+		targets.append("test") # also installs tests_require
+		# Setuptools BUG?
+		# - "python setup.py sdist test" handles both targets as expected
+		# - "python setup.py test sdist" handles "test" only :-(
+		# solution: flush targets after test
+		results = [("@trace", "previous failures not run first without [buildstack] shard_tests in setup.cfg")]
+		if failfast:
+			results.append(("@trace", "--fail-fast ignored without [buildstack] shard_tests in setup.cfg"))
+		return results + [("@flush",)]
+	else:
+		# unittest suite: shard it, building extensions in place beforehand as setup.py test does
+		targets.append("build_ext")
+		return run_tests(suite, vcs = vcs, failfast = failfast) # returned as is, to get the shard failures thrown in
 
 # *** EXPERIMENTAL ***
 def on_package(filename, targets, formatid):
-	# build OS/X package:
-	if formatid == "pkg":
-		args += ["bdist", "--format=tar"]
-		yield setup(filename, *args)
-		for path in glob.glob("dist/*.tar"):
-			yield "mkdir", "-p", "dist/root"
-			yield "tar", "-C", "dist/root", "-xf", path
-			basename, extname = os.path.splitext(path)
-			name, tail = basename.split("-", 1)
-			identifier = raw_input("identifier (e.g. fr.fclaerhout.%s)?" % name)
-			yield "pkgbuild", basename + ".pkg", "--root", "dist/root", "--version", version, "--identifier", identifier
-	# build debian package:
-	elif formatid == "deb":
-		# REF: https://nylas.com/blog/packaging-deploying-python
-		yield "make-deb", # generates inputs to dh_virtualenv and calls it
-		#TODO: generate requirements.txt from setup.py
-		yield "dpkg-buildpackage", "-us", "-uc"
-	# or let setuptools handle the packaging:
+	for formatid in (formatid or "sdist").split(","): # e.g. sdist,wheel
+		# build OS/X package:
+		if formatid == "pkg":
+			args += ["bdist", "--format=tar"]
+			yield setup(filename, *args)
+			for path in glob.glob("dist/*.tar"):
+				yield "mkdir", "-p", "dist/root"
+				yield "tar", "-C", "dist/root", "-xf", path
+				basename, extname = os.path.splitext(path)
+				name, tail = basename.split("-", 1)
+				identifier = raw_input("identifier (e.g. fr.fclaerhout.%s)?" % name)
+				yield "pkgbuild", basename + ".pkg", "--root", "dist/root", "--version", version, "--identifier", identifier
+		# build debian package:
+		elif formatid == "deb":
+			# REF: https://nylas.com/blog/packaging-deploying-python
+			yield "make-deb", # generates inputs to dh_virtualenv and calls it
+			#TODO: generate requirements.txt from setup.py
+			yield "dpkg-buildpackage", "-us", "-uc"
+		# or let setuptools handle the packaging:
+		else:
+			targets.append("package", formatid = formatid)
+
+def get_index_url(repositoryid):
+	"return the simple index url of the repository $repositoryid, as configured in ~/.pypirc"
+	parser = ConfigParser.RawConfigParser()
+	parser.read(PYPIRC_PATH)
+	if parser.has_option(repositoryid or "pypi", "repository"):
+		url = parser.get(repositoryid or "pypi", "repository")
 	else:
-		targets.append("package", formatid = formatid)
+		url = "https://upload.pypi.org/legacy/"
+	# upload.pypi.org/legacy/ -> pypi.org/simple/, HOST/ -> HOST/simple/
+	url = re.sub(r"/legacy$", "", url.replace("://upload.", "://", 1).rstrip("/"))
+	return "%s/simple/" % url
+
+def get_remote_digests(index_url, name):
+	"return the sha256 digests of the files of project $name on the index, or None and the reason if unknown"
+	try:
+		fp = urllib2.urlopen("%s%s/" % (index_url, re.sub(r"[-_.]+", "-", name).lower()), timeout = 30)
+		try:
+			return set(re.findall(r"#sha256=([0-9a-f]{64})", fp.read())), None
+		finally:
+			fp.close()
+	except urllib2.HTTPError as exc:
+		if exc.code == 404: # not published yet
+			return set(), None
+		return None, "%s: %s" % (index_url, exc)
+	except (urllib2.URLError, IOError) as exc:
+		return None, "%s: %s" % (index_url, exc)
+
+def get_digest(path):
+	digest = hashlib.sha256()
+	with open(path, "rb") as fp:
+		for chunk in iter(lambda: fp.read(1 << 16), ""):
+			digest.update(chunk)
+	return digest.hexdigest()
 
 def on_publish(filename, targets, repositoryid):
-	targets.append("register") # FIXME: should be done before first publish only
+	"upload the artifacts built by this run and not on the repository yet, concurrently"
+	mtimes = {path: os.path.getmtime(path) for path in glob.glob("dist/*")}
 	yield "@flush",
-	args = ["upload"] + glob.glob("dist/*")
-	if repositoryid:
-		args += ["--repository", repositoryid]
-	yield cat("twine", *args)
+	paths = sorted(path for path in glob.glob("dist/*") if mtimes.get(path) != os.path.getmtime(path))
+	index_url = get_index_url(repositoryid)
+	digests = {}
+	for path in paths[:]:
+		name = re.sub(r"-\d.*", "", os.path.basename(path)) # NAME-VERSION...
+		if name not in digests:
+			digests[name], reason = get_remote_digests(index_url, name)
+			if reason:
+				yield "@echo", "%s, uploading all %s files" % (reason, name)
+		if digests[name] and get_digest(path) in digests[name]:
+			yield "@echo", "%s: already published" % path
+			paths.remove(path)
+	if not paths:
+		yield "@echo", "nothing to publish"
+		return
+	args = ("--repository", repositoryid) if repositoryid else ()
+	# each twine process reuses its connection across the files of its shard
+	shards = shard(paths, {path: os.path.getsize(path) for path in paths}, min(get_jobs(), len(paths)))
+	if len(shards) > 1:
+		yield ("@parallel",) + tuple(("upload%i" % i, cat("twine", "upload", *(args + tuple(paths)))) for i, paths in enumerate(shards))
+	else:
+		yield cat("twine", "upload", *(args + tuple(paths)))
 
 def on_install(filename, targets, inventoryid):
 	yield "@flush"
@@ -109,60 +486,154 @@ def on_uninstall(filename, targets, inventoryid):
 	yield "@flush"
 	yield "pip", "uninstall", os.path.basename(os.getcwd())
 
-def on_release(filename, targets, partid, message, Version):
-	last_version = Version.parse_stdout("python", filename, "--version")
-	next_version = last_version.bump(partid)
+def _get_offset(text, lineno, col_offset, string):
+	"return the offset in $text of $string, searched from the given ast position"
+	lines = text.splitlines(True)
+	return text.index(string, sum(map(len, lines[:lineno - 1])) + max(0, col_offset))
+
+def get_version_literal(filename):
+	"""
+	Locate the project version literal without running setup.py,
+	looking up setup() keywords, then setup.cfg [metadata], then pyproject.toml.
+	Return (path, offset, version), or None if the version is computed dynamically.
+	"""
 	with open(filename, "r") as fp:
 		text = fp.read()
-	with open(filename, "w") as fp:
-		fp.write(text.replace(str(last_version), str(next_version)))
+	t = ast.parse(text, filename)
+	assignments = {} # module-level name = "literal"
+	for stmt in t.body:
+		if isinstance(stmt, ast.Assign)\
+		and len(stmt.targets) == 1\
+		and isinstance(stmt.targets[0], ast.Name)\
+		and isinstance(stmt.value, ast.Str):
+			assignments[stmt.targets[0].id] = stmt.value
+	for node in ast.walk(t):
+		if isinstance(node, ast.Call)\
+		and getattr(node.func, "attr", getattr(node.func, "id", None)) == "setup":
+			for kw in node.keywords:
+				if kw.arg == "version":
+					value = kw.value
+					if isinstance(value, ast.Name):
+						value = assignments.get(value.id, value)
+					if isinstance(value, ast.Str):
+						return filename, _get_offset(text, value.lineno, value.col_offset, value.s), value.s
+					return None
+	if os.path.exists("setup.cfg"):
+		parser = ConfigParser.RawConfigParser()
+		parser.read("setup.cfg")
+		if parser.has_option("metadata", "version"):
+			value = parser.get("metadata", "version")
+			if ":" in value: # attr: or file: directives
+				return None
+			with open("setup.cfg", "r") as fp:
+				text = fp.read()
+			match = re.search(
+				r"^\[metadata\]\s*$(?:(?!^\[).)*?^version\s*[=:]\s*(%s)\s*(?:[;#].*)?$" % re.escape(value),
+				text,
+				re.MULTILINE | re.DOTALL)
+			if match:
+				return "setup.cfg", match.start(1), value
+			return None # unusual layout, fall back on --version
+	if os.path.exists("pyproject.toml"):
+		with open("pyproject.toml", "r") as fp:
+			text = fp.read()
+		match = re.search(r"^\[(?:project|tool\.poetry)\]\s*$(?:(?!^\[).)*?^version\s*=\s*[\"']([^\"']+)[\"']", text, re.MULTILINE | re.DOTALL)
+		if match:
+			return "pyproject.toml", match.start(1), match.group(1)
+
+def on_release(filename, targets, partid, message, Version):
+	literal = get_version_literal(filename)
+	if literal:
+		path, offset, string = literal
+		last_version = Version.parse(string)
+		next_version = last_version.bump(partid)
+		with open(path, "r") as fp:
+			text = fp.read()
+		with open(path, "w") as fp:
+			fp.write(text[:offset] + str(next_version) + text[offset + len(string):])
+	else:
+		yield "@trace", "dynamic version, falling back on %s --version" % filename
+		last_version = Version.parse_stdout("python", filename, "--version")
+		next_version = last_version.bump(partid)
+		with open(filename, "r") as fp:
+			text = fp.read()
+		with open(filename, "w") as fp:
+			fp.write(text.replace(str(last_version), str(next_version)))
 	yield "@commit", "%s: %s" % (str(next_version), message) if message else str(next_version)
 	yield "@tag", str(next_version)
 	yield "@push",
 
-def on_flush(filename, targets):
+def get_package_commands(formatids):
+	"""
+	Return the setup.py arguments building the $formatids formats sequentially,
+	and the (label, arguments) of the formats to build concurrently afterwards.
+	Source formats are built by one sdist command; built formats share one build tree,
+	each using its own bdist and egg-info directories when run concurrently.
+	"""
 	args = []
+	sdist_formats = [SDIST_FORMATS[formatid] for formatid in formatids if formatid in SDIST_FORMATS]
+	if sdist_formats:
+		args.append("sdist")
+		if any(sdist_formats):
+			args.append("--formats=%s" % ",".join(sorted(set(fmt or "gztar" for fmt in sdist_formats))))
+	if "rpm" in formatids: # builds from the sdist, no build tree
+		args.append("bdist_rpm")
+	bdists = sorted(set(BDIST_COMMANDS[formatid] for formatid in formatids if formatid in BDIST_COMMANDS))
+	if len(bdists) == 1:
+		args.extend(bdists[0])
+		bdists = []
+	elif bdists:
+		args.append("build")
+	jobs = []
+	for bdist in bdists:
+		label = "-".join(arg.replace("--format=", "") for arg in bdist)
+		jobs.append((label, ("egg_info", "--egg-base", "build/egg.%s" % label)\
+			+ bdist\
+			+ ("--skip-build", "--bdist-dir", "build/bdist.%s" % label)))
+	return args, jobs
+
+def on_flush(filename, targets, vcs):
+	args = []
+	formatids = []
 	while targets:
 		target = targets.pop(0)
 		if target == "clean":
 			args += ["clean", "--all"]
 		elif target == "test":
 			args.append("test")
+		elif target == "build_ext":
+			args += ["egg_info", "build_ext", "--inplace"]
 		elif target == "package":
-			func = {
-				"sdist": lambda: args.append("sdist"),
-				"sdist:zip": lambda: args.extend(["sdist", "--format=zip"]),
-				"sdist:gztar": lambda: args.extend(["sdist", "--format=gztar"]),
-				"sdist:bztar": lambda: args.extend(["sdist", "--format=bztar"]),
-				"sdist:ztar": lambda: args.extend(["sdist", "--format=ztar"]),
-				"sdist:tar": lambda: args.extend(["sdist", "--format=tar"]),
-				"bdist": lambda: args.append("bdist"),
-				"bdist:gztar": lambda: args.extend(["sdist", "--format=gztar"]), # unix default
-				"bdist:ztar": lambda: args.extend(["sdist", "--format=ztar"]),
-				"bdist:tar": lambda: args.extend(["sdist", "--format=tar"]),
-				"bdist:zip": lambda: args.extend(["sdist", "--format=zip"]), # windows default
-				"rpm": lambda: args.extend(["sdist", "--format=rpm"]),
-				"pkgtool": lambda: args.extend(["sdist", "--format=pkgtool"]),
-				"sdux": lambda: args.extend(["sdist", "--format=sdux"]),
-				"wininst": lambda: args.extend(["sdist", "--format=wininst"]),
-				"msi": lambda: args.extend(["sdist", "--format=msi"]),
-			}
-			if not target.formatid:
-				target.formatid = "sdist"
-			elif target.formatid == "help":
-				raise SystemExit("\n".join(["deb", "pkg"] + func.keys()))
-			elif target.formatid not in func:
+			known = sorted(SDIST_FORMATS.keys() + BDIST_COMMANDS.keys() + ["rpm"])
+			if target.formatid == "help":
+				raise SystemExit("\n".join(["deb", "pkg"] + known))
+			elif (target.formatid or "sdist") not in known:
 				yield "%s: unsupported format id" % target.formatid
-			func[target.formatid]()
+			formatids.append(target.formatid or "sdist")
 		elif target == "register":
 			args.append("register")
 		else:
 			yield "%s: unexpected target" % target
+	package_args, jobs = get_package_commands(formatids)
+	args += package_args
 	if args:
-		yield cat("python", filename, *args)
+		before, python, after = yield ("@resolve", "python", filename) + tuple(args)
+		if before or after:
+			yield ("python", filename) + tuple(args) # hooks set, run it as any other command
+		else:
+			yield ("@trace",) + tuple(python)
+			status = get_interpreter(python[0]).run(*python[1:])
+			if status:
+				yield "%s: exit status %i" % (" ".join(python), status)
+	if jobs: # built formats, from the build tree prepared above
+		for label, _ in jobs:
+			if not os.path.exists("build/egg.%s" % label):
+				os.makedirs("build/egg.%s" % label)
+		yield ("@parallel",) + tuple((label, ("python", filename) + args) for label, args in jobs)
 
 MANIFEST = {
 	"filenames": ("setup.py",),
+	"requirements": ("requirements*.txt",),
 	"on_get": on_get,
 	"on_clean": on_clean,
 	"on_compile": None,
@@ -0,0 +1,145 @@
+# copyright (c) 2015 fclaerhout.fr, released under the MIT license.
+
+"""
+Unittest worker used by the setuptools build stack to run sharded test suites.
+This script is run by the project interpreter, it must not import buildstack
+and must remain compatible with python 2 and 3.
+
+Usage:
+  testrunner.py discover SUITE OUTFILE  write the JSON list of test ids of SUITE ("" to discover)
+  testrunner.py run INFILE OUTFILE [cover] [failfast]
+                                        run the JSON list of test ids in order, write the JSON results;
+                                        with cover, also record the project files each test executes;
+                                        with failfast, stop and exit 1 on the first failure
+SIGTERM stops the run after the current test, the results collected so far are still written.
+"""
+
+import unittest, signal, json, time, sys, os
+
+class TimedResult(unittest.TextTestResult):
+	"text result also recording the status and duration of each test"
+
+	cover = False
+
+	def __init__(self, *args, **kwargs):
+		super(TimedResult, self).__init__(*args, **kwargs)
+		self.records = []
+		self.files = None
+		self.root = os.getcwd() + os.sep
+
+	def startTestRun(self):
+		super(TimedResult, self).startTestRun()
+		# e.g. a sibling worker failed fast; restored after the run, the builtin stack runs in-process
+		self.sigterm = signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+	def stopTestRun(self):
+		signal.signal(signal.SIGTERM, self.sigterm)
+		super(TimedResult, self).stopTestRun()
+
+	def _trace(self, frame, event, arg):
+		# 'call' events only: the file set is enough, line tracing is too costly
+		path = frame.f_code.co_filename
+		if path.startswith(self.root):
+			self.files.add(os.path.relpath(path, self.root))
+		elif not os.path.isabs(path):
+			self.files.add(os.path.normpath(path))
+
+	def startTest(self, test):
+		self.start = time.time()
+		super(TimedResult, self).startTest(test)
+		if self.cover:
+			self.files = set()
+			sys.settrace(self._trace)
+
+	def stopTest(self, test):
+		sys.settrace(None)
+		self.files = None
+		super(TimedResult, self).stopTest(test)
+
+	def _record(self, test, status, message = None):
+		record = {
+			"id": test.id(),
+			"status": status,
+			"duration": time.time() - self.start,
+			"message": message,
+		}
+		if self.files is not None:
+			record["files"] = sorted(path for path in self.files if path.endswith(".py"))
+		self.records.append(record)
+
+	def addSuccess(self, test):
+		super(TimedResult, self).addSuccess(test)
+		self._record(test, "success")
+
+	def addFailure(self, test, err):
+		super(TimedResult, self).addFailure(test, err)
+		self._record(test, "failure", self.failures[-1][1])
+
+	def addError(self, test, err):
+		super(TimedResult, self).addError(test, err)
+		if not hasattr(self, "start"): # setUpClass/setUpModule failure
+			self.start = time.time()
+		self._record(test, "error", self.errors[-1][1])
+
+	def addSkip(self, test, reason):
+		super(TimedResult, self).addSkip(test, reason)
+		self._record(test, "skipped", reason)
+
+	def addExpectedFailure(self, test, err):
+		super(TimedResult, self).addExpectedFailure(test, err)
+		self._record(test, "success")
+
+	def addUnexpectedSuccess(self, test):
+		super(TimedResult, self).addUnexpectedSuccess(test)
+		self._record(test, "failure", "unexpected success")
+
+def report(records, count = 10):
+	"return the lines listing the $count slowest tests"
+	lines = ["slowest tests:"]
+	for record in sorted(records, key = lambda record: -record["duration"])[:count]:
+		lines.append("  %6.2fs %s" % (record["duration"], record["id"]))
+	return lines
+
+def iter_ids(suite):
+	for test in suite:
+		if isinstance(test, unittest.TestSuite):
+			for testid in iter_ids(test):
+				yield testid
+		else:
+			yield test.id()
+
+def discover(name, outfile):
+	loader = unittest.defaultTestLoader
+	if not name:
+		suite = loader.discover(".")
+	elif os.path.isdir(name.replace(".", os.sep)): # package: scan all its modules, as setuptools does
+		suite = loader.discover(name.replace(".", os.sep), pattern = "*.py", top_level_dir = ".")
+	else:
+		suite = loader.loadTestsFromName(name)
+	with open(outfile, "w") as fp:
+		json.dump(list(iter_ids(suite)), fp)
+
+def run(infile, outfile, *flags):
+	with open(infile, "r") as fp:
+		testids = json.load(fp)
+	records = []
+	suite = unittest.TestSuite()
+	for testid in testids:
+		try:
+			suite.addTests(unittest.defaultTestLoader.loadTestsFromName(testid))
+		except Exception as exc: # e.g. module import failure
+			records.append({"id": testid, "status": "error", "duration": 0, "message": "%s" % exc})
+	TimedResult.cover = "cover" in flags
+	failfast = "failfast" in flags
+	if failfast and records:
+		suite = unittest.TestSuite()
+	result = unittest.TextTestRunner(verbosity = 2, failfast = failfast, resultclass = TimedResult).run(suite)
+	records += result.records
+	with open(outfile, "w") as fp:
+		json.dump(records, fp)
+	if failfast and any(record["status"] in ("failure", "error") for record in records):
+		sys.exit(1)
+
+if __name__ == "__main__":
+	sys.path[0] = os.getcwd() # import the project modules, not the buildstack ones
+	{"discover": discover, "run": run}[sys.argv[1]](*sys.argv[2:])
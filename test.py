@@ -1,9 +1,11 @@
 # copyright (c) 2014 fclaerhout.fr, released under the MIT license.
 
-import unittest, sys, os
+import BaseHTTPServer, subprocess, threading, unittest, StringIO, textwrap, tarfile, hashlib, select, signal, json, time, sys, os
 
 import buildstack, fckit # 3rd-party
 
+ROOT = os.path.dirname(os.path.abspath(__file__)) # importable path of buildstack, for subprocesses
+
 ################
 # CORE TESTING #
 ################
@@ -35,20 +37,36 @@ MANIFEST = {
 	"on_flush": _foo_on_flush,
 }
 
-class CoreTest(unittest.TestCase):
+class WorkdirTestCase(unittest.TestCase):
+	"run each test from a new directory, the module globals listed in PATHS pointing into it"
+
+	PATHS = () # (module, name, path relative to the test directory)
 
 	def setUp(self):
-		# generate build manifest
+		self.cwd = os.getcwd()
 		self.dirname = fckit.mkdir()
+		os.chdir(self.dirname)
+		self.paths = [(module, name, getattr(module, name)) for module, name, _ in self.PATHS]
+		for module, name, path in self.PATHS:
+			setattr(module, name, os.path.join(self.dirname, path))
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		for module, name, value in self.paths:
+			setattr(module, name, value)
+		fckit.remove(self.dirname)
+
+class CoreTest(WorkdirTestCase):
+
+	def setUp(self):
+		super(CoreTest, self).setUp()
+		# generate build manifest
 		with open(os.path.join(self.dirname, "Foobuild"), "w") as fp:
 			fp.write(FOOBUILD)
 		self.buildstack = buildstack.BuildStack(
 			manifests = (MANIFEST,),
 			path = self.dirname)
 
-	def tearDown(self):
-		fckit.remove(self.dirname)
-
 	def assert_done(self, name):
 		self.assertTrue(os.path.exists(os.path.join(self.dirname, "foo.%s" % name)))
 
@@ -94,6 +112,74 @@ class CoreTest(unittest.TestCase):
 		self.buildstack.flush()
 		self.assert_done("uninstall")
 
+	def test_failure_thrown_back(self):
+		events = []
+		def on_test(filename, targets):
+			try:
+				yield "sh", "-c", "exit 3"
+			except fckit.Error:
+				events.append("except")
+				raise
+			finally:
+				events.append("finally")
+		self.buildstack.manifest = dict(MANIFEST, on_test = on_test)
+		self.assertRaises(fckit.Error, self.buildstack.test)
+		self.assertEqual(events, ["except", "finally"])
+
+	def test_optional_kwargs(self):
+		flags = []
+		def on_test(filename, targets, failfast): # vcs not declared
+			flags.append(failfast)
+			return ()
+		self.buildstack.manifest = dict(MANIFEST, on_test = on_test)
+		self.buildstack.test()
+		self.assertEqual(flags, [False])
+
+	def test_parallel_returncodes(self):
+		returncodes = []
+		def on_test(filename, targets):
+			try:
+				yield "@parallel", ("ok", ("true",)), ("ko", ("false",))
+			except buildstack.Error as exc:
+				returncodes.append(exc.returncodes)
+		self.buildstack.manifest = dict(MANIFEST, on_test = on_test)
+		self.buildstack.test()
+		self.assertEqual(returncodes, [{"ok": 0, "ko": 1}])
+
+	def test_resolve(self):
+		self.buildstack.preferences = {"bash": {"path": "/bin/bash", "append": ["x"]}}
+		resolved = []
+		def on_test(filename, targets):
+			resolved.append((yield "@resolve", "bash", filename))
+			resolved.append((yield "@output", "echo", "y"))
+		self.buildstack.preferences["echo"] = {"append": ["z"]}
+		self.buildstack.manifest = dict(MANIFEST, on_test = on_test)
+		self.buildstack.test()
+		self.assertEqual(resolved, [([], ["/bin/bash", "Foobuild", "x"], []), "y z\n"])
+
+class VcsTest(WorkdirTestCase):
+
+	def setUp(self):
+		super(VcsTest, self).setUp()
+		subprocess.check_call(("git", "init", "-q"))
+
+	def test_no_revision(self):
+		self.assertIsNone(buildstack.Vcs().get_revision()) # no commit yet
+
+	def test_changes(self):
+		with open("tracked", "w") as fp:
+			fp.write("a")
+		subprocess.check_call(("git", "add", "tracked"))
+		subprocess.check_call(("git", "-c", "user.name=x", "-c", "user.email=x@x", "commit", "-q", "-m", "init"))
+		vcs = buildstack.Vcs()
+		revision = vcs.get_revision()
+		with open("tracked", "w") as fp:
+			fp.write("b")
+		with open("untracked", "w") as fp:
+			fp.write("c")
+		self.assertEqual(sorted(vcs.get_changes(revision)), ["tracked", "untracked"])
+		self.assertIsNone(vcs.get_changes("nosuchrevision"))
+
 class VersionTest(unittest.TestCase):
 
 	def setUp(self):
@@ -111,4 +197,988 @@ class VersionTest(unittest.TestCase):
 	def test_bump_N(self):
 		self.assertEqual(self.version.bump(3).number, buildstack.Version(1, 2, 3, 1).number)
 
+class JobserverTest(unittest.TestCase):
+
+	def setUp(self):
+		self.environ = dict(os.environ)
+		os.environ.pop("MAKEFLAGS", None)
+
+	def tearDown(self):
+		os.environ.clear()
+		os.environ.update(self.environ)
+
+	def test_tokens(self):
+		jobserver = buildstack.Jobserver(3)
+		self.assertIn("-j3", os.environ["MAKEFLAGS"])
+		self.assertEqual(os.environ["CARGO_MAKEFLAGS"], os.environ["MAKEFLAGS"])
+		tokens = [jobserver.acquire(), jobserver.acquire()]
+		self.assertFalse(select.select([jobserver.rfd], [], [], 0)[0]) # 3rd slot is implicit
+		for token in tokens:
+			jobserver.release(token)
+
+	def test_join(self):
+		jobserver = buildstack.Jobserver(3)
+		nested = buildstack.Jobserver(8)
+		self.assertEqual((nested.rfd, nested.wfd, nested.jobs), (jobserver.rfd, jobserver.wfd, 3))
+
+	def test_close(self):
+		jobserver = buildstack.Jobserver(3)
+		jobserver.close()
+		self.assertNotIn("MAKEFLAGS", os.environ)
+		self.assertFalse(buildstack.Jobserver._is_open(jobserver.rfd))
+
+	def test_fifo(self):
+		path = os.path.join(fckit.mkdir(), "fifo")
+		os.mkfifo(path)
+		fd = os.open(path, os.O_RDWR)
+		os.write(fd, "++")
+		os.environ["MAKEFLAGS"] = "-j3 --jobserver-auth=fifo:%s" % path
+		jobserver = buildstack.Jobserver(8)
+		self.assertEqual(jobserver.jobs, 3)
+		self.assertEqual(jobserver.acquire(), "+")
+		jobserver.close()
+		self.assertEqual(os.environ["MAKEFLAGS"], "-j3 --jobserver-auth=fifo:%s" % path) # not ours
+		os.close(fd)
+
+class MultiplexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.environ = dict(os.environ)
+		os.environ.pop("MAKEFLAGS", None)
+
+	def tearDown(self):
+		os.environ.clear()
+		os.environ.update(self.environ)
+
+	def test_slots(self):
+		jobserver = buildstack.Jobserver(1) # no token, the implicit slot only
+		start = time.time()
+		returncodes = buildstack.multiplex(
+			{"job%i" % i: (("sleep", ".1"), {}) for i in range(3)},
+			jobserver = jobserver)
+		self.assertEqual(returncodes, {"job0": 0, "job1": 0, "job2": 0})
+		self.assertGreaterEqual(time.time() - start, .3) # run one after the other
+
+	def test_failfast(self):
+		returncodes = buildstack.multiplex({
+			"ko": (("sh", "-c", "exit 3"), {}),
+			"slow": (("sleep", "10"), {}),
+		}, failfast = True)
+		self.assertEqual(returncodes, {"ko": 3, "slow": None})
+
+class SweepTest(WorkdirTestCase):
+
+	def setUp(self):
+		super(SweepTest, self).setUp()
+		for path in (".git/a.pyc", "venv/pyvenv.cfg", "venv/a.pyc", "pkg/__pycache__/a.pyc", "pkg/b.pyc", "pkg/b.py", "dist/foo.tgz"):
+			if not os.path.exists(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			with open(path, "w") as fp:
+				fp.write("")
+
+	def test_sweep(self):
+		self.assertEqual(buildstack.sweep(("*.pyc", "__pycache__", "/dist"), jobs = 2, batch_size = 1), 3)
+		for path in (".git/a.pyc", "venv/a.pyc", "pkg/b.py"):
+			self.assertTrue(os.path.exists(path))
+		for path in ("pkg/__pycache__", "pkg/b.pyc", "dist"):
+			self.assertFalse(os.path.exists(path))
+
+class WorkspaceTest(WorkdirTestCase):
+
+	def setUp(self):
+		super(WorkspaceTest, self).setUp()
+		self.src = os.path.join(self.dirname, "src")
+		os.makedirs(os.path.join(self.src, ".git", "objects", "00"))
+		for path in (".git/objects/00/00", "Foobuild"):
+			with open(os.path.join(self.src, path), "w") as fp:
+				fp.write(path)
+		os.symlink("Foobuild", os.path.join(self.src, "Foolink"))
+
+	def test_clone_workspace(self):
+		dst = os.path.join(self.dirname, "dst")
+		buildstack.clone_workspace(self.src, dst)
+		self.assertEqual(
+			os.stat(os.path.join(self.src, ".git/objects/00/00")).st_ino,
+			os.stat(os.path.join(dst, ".git/objects/00/00")).st_ino)
+		self.assertEqual(os.readlink(os.path.join(dst, "Foolink")), "Foobuild")
+		with open(os.path.join(dst, "Foobuild"), "w") as fp:
+			fp.write("modified")
+		with open(os.path.join(self.src, "Foobuild")) as fp:
+			self.assertEqual(fp.read(), "Foobuild")
+
+	def test_run_matrix(self):
+		with open(os.path.join(self.src, "Makefile"), "w") as fp:
+			fp.write("all:\n\techo $$BUILDSTACK_PROFILE > out\n")
+		os.chdir(self.dirname)
+		environ = dict(os.environ)
+		os.environ["PYTHONPATH"] = ROOT
+		try:
+			buildstack.run_matrix(["a", "b"], ["compile"], path = self.src, jobs = 2)
+			buildstack.run_matrix(["a", "b"], ["compile"], path = self.src, jobs = 2) # previous clones are not cloned
+		finally:
+			os.environ.clear()
+			os.environ.update(environ)
+		for profileid in ("a", "b"): # artifacts are kept
+			with open(os.path.join(self.src, buildstack.MATRIX_PATH, profileid, "out")) as fp:
+				self.assertEqual(fp.read(), "%s\n" % profileid)
+		self.assertFalse(os.path.exists(os.path.join(self.src, buildstack.MATRIX_PATH, "a", buildstack.MATRIX_PATH)))
+
+class WatcherTest(WorkdirTestCase):
+
+	def setUp(self):
+		super(WatcherTest, self).setUp()
+		os.makedirs(os.path.join(self.dirname, "src"))
+
+	def test_wait(self):
+		watcher = buildstack.Watcher()
+		def touch():
+			for path in ("src/foo.c", "src/bar.c", ".git"):
+				with open(path, "w") as fp:
+					fp.write("")
+		fckit.async(touch)
+		self.assertEqual(watcher.wait(), set(("src/foo.c", "src/bar.c")))
+
+class WatchTest(WorkdirTestCase):
+
+	def setUp(self):
+		super(WatchTest, self).setUp()
+		self.bs = type("FakeBuildStack", (object,), {"manifest": {"requirements": ("requirements.txt",)}, "targets": [], "vcs": buildstack.Vcs()})()
+
+	def test_watch(self):
+		runs = []
+		def run(targets):
+			runs.append(targets)
+			if len(runs) == 1: # saved during the run: triggers the next one
+				with open("foo.c", "w") as fp:
+					fp.write("")
+				raise ValueError("not a buildstack error")
+			elif len(runs) == 2:
+				with open("requirements.txt", "w") as fp:
+					fp.write("")
+			else:
+				raise KeyboardInterrupt
+		buildstack.watch(self.bs, run, ["compile"])
+		self.assertEqual(runs, [["compile"], ["compile"], ["get", "compile"]])
+
+	def test_ignored_outputs(self):
+		subprocess.check_call(("git", "init", "-q"))
+		with open(".gitignore", "w") as fp:
+			fp.write("target/\n")
+		self.bs.vcs = buildstack.Vcs()
+		runs = []
+		def run(targets):
+			runs.append(targets)
+			if len(runs) == 1: # build output: must not trigger the next run, the later requirement change does
+				os.mkdir("target")
+				with open("target/app.o", "w") as fp:
+					fp.write("")
+				threading.Timer(.5, lambda: open(os.path.join(self.dirname, "requirements.txt"), "w").close()).start()
+			else:
+				raise KeyboardInterrupt
+		buildstack.watch(self.bs, run, ["compile"])
+		self.assertEqual(runs, [["compile"], ["get", "compile"]])
+
+###################
+# BUILTIN TESTING #
+###################
+
+class BuiltinPackageTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dirname = fckit.mkdir()
+		self.root = buildstack.builtin.Dir(self.dirname)
+
+	def tearDown(self):
+		fckit.remove(self.dirname)
+
+	def test_link_from(self):
+		src = self.root.File("hello").write("hello")
+		dst = self.root.Dir("stage").File("hello").link_from(src.path)
+		self.assertEqual(dst.read(), "hello")
+		self.assertEqual(os.stat(src.path).st_ino, os.stat(dst.path).st_ino)
+
+	def test_deb_from(self):
+		pkgdir = self.root.Dir("hello_root")
+		pkgdir.Dir("DEBIAN").File("control").write("Package: hello\n")
+		pkgdir.Dir("usr").File("hello").write("hello")
+		deb = self.root.File("hello.deb").deb_from(pkgdir.path)
+		with open(deb.path, "rb") as fp:
+			self.assertEqual(fp.read(8), "!<arch>\n")
+			members = {}
+			while True:
+				header = fp.read(60)
+				if not header:
+					break
+				name, size = header[:16].strip(), int(header[48:58])
+				members[name] = fp.read(size)
+				fp.read(size % 2)
+		self.assertEqual(members["debian-binary"], "2.0\n")
+		with tarfile.open(fileobj = StringIO.StringIO(members["control.tar.gz"])) as tar:
+			self.assertIn("./control", tar.getnames())
+		with tarfile.open(fileobj = StringIO.StringIO(members["data.tar.gz"])) as tar:
+			self.assertEqual(tar.getmember("./usr/hello").uname, "root")
+			self.assertNotIn("./DEBIAN", tar.getnames())
+
+class BuiltinGetTest(WorkdirTestCase):
+
+	PATHS = ((buildstack.builtin, "STORE_PATH", "store"),)
+
+	def setUp(self):
+		super(BuiltinGetTest, self).setUp()
+		# generate two local bare git repositories
+		for name in ("foo", "bar"):
+			workdir = os.path.join(self.dirname, name)
+			os.makedirs(os.path.join(workdir, "source"))
+			with open(os.path.join(workdir, "source", "%s.c" % name), "w") as fp:
+				fp.write(name)
+			for args in (
+				("init", "--quiet"),
+				("add", "."),
+				("-c", "user.name=test", "-c", "user.email=test@localhost", "commit", "--quiet", "-m", name),
+				("clone", "--quiet", "--bare", ".", "../%s.git" % name)):
+				subprocess.check_call(("git",) + args, cwd = workdir)
+		os.makedirs(os.path.join(self.dirname, "project"))
+		with open(os.path.join(self.dirname, "project", "build.ini"), "w") as fp:
+			fp.write("[install:]\n")
+
+	def get(self, *requirementids):
+		bs = buildstack.BuildStack(
+			manifests = [manifest for manifest in buildstack.MANIFESTS if manifest["name"] == "builtin"],
+			path = os.path.join(self.dirname, "project"))
+		for requirementid in requirementids:
+			bs.get(requirementid = requirementid)
+		bs.flush()
+
+	def test_get_repositories(self):
+		self.get(
+			os.path.join(self.dirname, "foo.git"),
+			os.path.join(self.dirname, "bar.git/source/bar.c"))
+		self.assertTrue(os.path.exists("vendor/foo/source/foo.c"))
+		self.assertTrue(os.path.exists("vendor/bar.c"))
+		self.assertEqual(len(os.listdir(buildstack.builtin.STORE_PATH)), 2)
+
+	def test_get_cached(self):
+		self.get(os.path.join(self.dirname, "foo.git"))
+		entry, = os.listdir(buildstack.builtin.STORE_PATH)
+		fckit.remove("vendor")
+		self.get(os.path.join(self.dirname, "foo.git"))
+		self.assertEqual(os.listdir(buildstack.builtin.STORE_PATH), [entry])
+		self.assertTrue(os.path.exists("vendor/foo/source/foo.c"))
+
+	def test_get_copies(self):
+		remote = os.path.join(self.dirname, "foo.git")
+		self.get(remote)
+		revision = subprocess.check_output(("git", "rev-parse", "HEAD"), cwd = remote).strip()
+		entry, = os.listdir(buildstack.builtin.STORE_PATH)
+		self.assertEqual(entry, hashlib.sha1("%s@%s" % (remote, revision)).hexdigest()) # keyed by the cloned revision
+		with open("vendor/foo/source/foo.c", "w") as fp:
+			fp.write("edited")
+		with open(os.path.join(buildstack.builtin.STORE_PATH, entry, "source", "foo.c")) as fp:
+			self.assertEqual(fp.read(), "foo") # the store is not affected by vendor edits
+
+######################
+# SETUPTOOLS TESTING #
+######################
+
+class SetuptoolsReleaseTest(WorkdirTestCase):
+
+	def write(self, path, text):
+		with open(path, "w") as fp:
+			fp.write(textwrap.dedent(text))
+
+	def test_setup_literal(self):
+		self.write("setup.py", """
+			import setuptools
+			VERSION = "1.2.3"
+			setuptools.setup(name = "1.2.3", version = VERSION)
+			""")
+		path, offset, version = buildstack.setuptools.get_version_literal("setup.py")
+		self.assertEqual((path, version), ("setup.py", "1.2.3"))
+		with open(path) as fp:
+			self.assertEqual(fp.read()[offset - 11:offset + 6], 'VERSION = "1.2.3"')
+
+	def test_setup_dynamic(self):
+		self.write("setup.py", """
+			import setuptools, foo
+			setuptools.setup(name = "foo", version = foo.__version__)
+			""")
+		self.assertIsNone(buildstack.setuptools.get_version_literal("setup.py"))
+
+	def test_setup_cfg(self):
+		self.write("setup.py", "import setuptools; setuptools.setup()")
+		self.write("setup.cfg", """
+			[metadata]
+			name = foo
+			version = 0.1
+			""")
+		path, offset, version = buildstack.setuptools.get_version_literal("setup.py")
+		self.assertEqual((path, version), ("setup.cfg", "0.1"))
+
+	def test_setup_cfg_comment(self):
+		self.write("setup.py", "import setuptools; setuptools.setup()")
+		self.write("setup.cfg", """
+			[bdist_wheel]
+			version = 0.1
+			[metadata]
+			version = 0.1 ; released
+			""")
+		path, offset, version = buildstack.setuptools.get_version_literal("setup.py")
+		self.assertEqual((path, version), ("setup.cfg", "0.1"))
+		with open(path) as fp:
+			self.assertEqual(fp.read()[offset - 10:], "version = 0.1 ; released\n")
+
+	def test_release(self):
+		self.write("setup.py", """
+			import setuptools
+			setuptools.setup(name = "foo", version = "1.1", description = "1.1")
+			""")
+		commands = list(buildstack.setuptools.on_release(
+			filename = "setup.py",
+			targets = None,
+			partid = "minor",
+			message = None,
+			Version = buildstack.Version))
+		with open("setup.py") as fp:
+			self.assertIn('version = "1.2", description = "1.1"', fp.read())
+		self.assertEqual(commands[0], ("@commit", "1.2"))
+
+class SetuptoolsGetTest(WorkdirTestCase):
+
+	PATHS = ((buildstack.setuptools, "WHEELHOUSE_PATH", "wheelhouse"),)
+
+	def setUp(self):
+		super(SetuptoolsGetTest, self).setUp()
+		os.mkdir("site") # simulated environment
+
+	def get(self):
+		"run on_get, simulating pip, return the pip subcommands"
+		commands = []
+		results = buildstack.setuptools.on_get("setup.py", [], "")
+		value = None
+		while True:
+			try:
+				res = results.send(value)
+			except StopIteration:
+				return commands
+			value = None
+			if res == ("@output", "pip", "--version"):
+				value = "pip 9.0.1 from %s (python 2.7)\n" % os.path.abspath("site/pip")
+			elif res[0] == "pip":
+				commands.append(res[1])
+				if res[1] == "wheel":
+					os.makedirs(res[3])
+
+	def test_wheelhouse(self):
+		with open("base.txt", "w") as fp:
+			fp.write("foo==1.0\n")
+		with open("requirements.txt", "w") as fp:
+			fp.write("-r base.txt\n")
+		self.assertEqual(self.get(), ["wheel", "install"])
+		self.assertEqual(self.get(), []) # environment up-to-date
+		with open("base.txt", "a") as fp:
+			fp.write("bar==1.0\n")
+		self.assertEqual(self.get(), ["wheel", "install"])
+		fckit.remove("site")
+		os.mkdir("site")
+		self.assertEqual(self.get(), ["install"]) # recreated environment, wheelhouse hit
+		self.assertEqual(len(os.listdir("wheelhouse")), 2)
+
+class SetuptoolsPublishTest(WorkdirTestCase):
+
+	PATHS = ((buildstack.setuptools, "PYPIRC_PATH", ".pypirc"),)
+
+	def setUp(self):
+		super(SetuptoolsPublishTest, self).setUp()
+		# local stand-in index, serving the simple page of project foo
+		digest = hashlib.sha256("published").hexdigest()
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path == "/simple/foo/":
+					self.send_response(200)
+					self.end_headers()
+					self.wfile.write("<a href=\"../../foo-1.0.tar.gz#sha256=%s\">foo-1.0.tar.gz</a>" % digest)
+				else:
+					self.send_error(404)
+			def log_message(self, *args): pass
+		self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+		threading.Thread(target = self.server.serve_forever).start()
+		with open(buildstack.setuptools.PYPIRC_PATH, "w") as fp:
+			fp.write("[local]\nrepository = http://127.0.0.1:%i/\n" % self.server.server_port)
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		super(SetuptoolsPublishTest, self).tearDown()
+
+	def test_index_url(self):
+		self.assertEqual(buildstack.setuptools.get_index_url("pypi"), "https://pypi.org/simple/")
+		self.assertEqual(buildstack.setuptools.get_index_url("local"), "http://127.0.0.1:%i/simple/" % self.server.server_port)
+
+	def test_publish(self):
+		os.mkdir("dist")
+		with open("dist/foo-0.9.tar.gz", "w") as fp:
+			fp.write("stale")
+		commands = []
+		for res in buildstack.setuptools.on_publish("setup.py", [], "local"):
+			if res[0] == "@flush": # simulate the package target
+				for basename, content in (("foo-1.0.tar.gz", "published"), ("foo-1.0-py2-none-any.whl", "new")):
+					with open(os.path.join("dist", basename), "w") as fp:
+						fp.write(content)
+			elif res[0] != "@echo":
+				commands.append(res)
+		self.assertEqual(commands, [("twine", "upload", "--repository", "local", "dist/foo-1.0-py2-none-any.whl")])
+
+	def test_remote_digests(self):
+		index_url = buildstack.setuptools.get_index_url("local")
+		self.assertEqual(buildstack.setuptools.get_remote_digests(index_url, "bar"), (set(), None)) # not published yet
+		digests, reason = buildstack.setuptools.get_remote_digests("http://127.0.0.1:1/simple/", "foo")
+		self.assertIsNone(digests)
+		self.assertTrue(reason.startswith("http://127.0.0.1:1/simple/: "))
+
+class SetuptoolsRunTest(WorkdirTestCase):
+
+	def setUp(self):
+		super(SetuptoolsRunTest, self).setUp()
+		with open("setup.py", "w") as fp:
+			fp.write("from setuptools import setup\nsetup(name = 'foo', entry_points = ENTRY_POINTS)\n")
+
+	def test_literal(self):
+		with open("setup.py", "w") as fp:
+			fp.write("from setuptools import setup\nsetup(name = 'foo', entry_points = {'console_scripts': ['foo = foo.cli:main [extra]']})\n")
+		self.assertEqual(buildstack.setuptools.get_entry_points("setup.py"), {"foo": "foo.cli:main"})
+
+	def test_metadata(self):
+		os.mkdir("foo.egg-info")
+		with open("foo.egg-info/entry_points.txt", "w") as fp:
+			fp.write("[console_scripts]\nFoo = foo:main\n\n[gui_scripts]\nbar = foo.gui:App.run\n")
+		self.assertEqual(buildstack.setuptools.get_entry_points("setup.py"), {"Foo": "foo:main", "bar": "foo.gui:App.run"})
+
+	def test_run_all(self):
+		os.mkdir("foo.egg-info")
+		with open("foo.egg-info/entry_points.txt", "w") as fp:
+			fp.write("[console_scripts]\nfoo = foo:main\nbar = foo:bar\n")
+		commands = list(buildstack.setuptools.on_run("setup.py", [], None))
+		self.assertEqual(commands[1], ("@parallel",
+			("bar", ("python", "-c", "import sys, foo; sys.exit(foo.bar())")),
+			("foo", ("python", "-c", "import sys, foo; sys.exit(foo.main())"))))
+
+class SetuptoolsPackageTest(unittest.TestCase):
+
+	def test_single_format(self):
+		self.assertEqual(
+			buildstack.setuptools.get_package_commands(["wheel"]),
+			(["bdist_wheel"], []))
+
+	def test_multiple_formats(self):
+		args, jobs = buildstack.setuptools.get_package_commands(["sdist", "sdist:zip", "wheel", "bdist:zip"])
+		self.assertEqual(args, ["sdist", "--formats=gztar,zip", "build"])
+		self.assertEqual(jobs, [
+			("bdist_dumb-zip", ("egg_info", "--egg-base", "build/egg.bdist_dumb-zip", "bdist_dumb", "--format=zip", "--skip-build", "--bdist-dir", "build/bdist.bdist_dumb-zip")),
+			("bdist_wheel", ("egg_info", "--egg-base", "build/egg.bdist_wheel", "bdist_wheel", "--skip-build", "--bdist-dir", "build/bdist.bdist_wheel")),
+		])
+
+class SetuptoolsInterpreterTest(WorkdirTestCase):
+
+	def setUp(self):
+		super(SetuptoolsInterpreterTest, self).setUp()
+		with open("setup.py", "w") as fp:
+			fp.write("import os, setuptools\nopen('pids', 'a').write('%i\\n' % os.getpid())\nsetuptools.setup(name = 'foo')\n")
+
+	def test_run(self):
+		interpreter = buildstack.setuptools.Interpreter()
+		try:
+			self.assertEqual(interpreter.run("setup.py", "--name"), 0)
+			self.assertEqual(interpreter.run("setup.py", "--name"), 0)
+			self.assertNotEqual(interpreter.run("setup.py", "nosuchcommand"), 0)
+		finally:
+			interpreter.close()
+		with open("pids") as fp:
+			self.assertEqual(len(set(fp.read().split())), 1)
+
+	def test_get_interpreter(self):
+		interpreter = buildstack.setuptools.get_interpreter(sys.executable)
+		try:
+			self.assertIs(buildstack.setuptools.get_interpreter(sys.executable), interpreter)
+			os.mkdir("sub")
+			os.chdir("sub")
+			other = buildstack.setuptools.get_interpreter(sys.executable)
+			self.assertIsNot(other, interpreter) # per directory
+			other.close()
+		finally:
+			interpreter.close()
+
+class SetuptoolsTestTest(WorkdirTestCase):
+
+	def test_shard(self):
+		shards = buildstack.setuptools.shard(
+			testids = ["a", "b", "c", "d", "e"],
+			durations = {"a": 4, "b": 3, "c": 2, "d": 1},
+			count = 2)
+		self.assertEqual(shards, [["a", "c"], ["b", "e", "d"]]) # e has the average duration
+
+	def test_sharding_opt_in(self):
+		with open("setup.py", "w") as fp:
+			fp.write("import setuptools\nsetuptools.setup(name = 'foo', test_suite = 'tests')\n")
+		targets = buildstack.Targets()
+		results = buildstack.setuptools.on_test("setup.py", targets, None, True)
+		self.assertEqual([res[0] for res in results], ["@trace", "@trace", "@flush"]) # failed-first and fail-fast ignored
+		self.assertEqual([target.name for target in targets], ["test"]) # setup.py test, installing tests_require
+		with open("setup.cfg", "w") as fp:
+			fp.write("[buildstack]\nshard_tests = true\n")
+		targets = buildstack.Targets()
+		self.assertTrue(hasattr(buildstack.setuptools.on_test("setup.py", targets, None, False), "send"))
+		self.assertEqual([target.name for target in targets], ["build_ext"])
+
+	def test_shard_first(self):
+		shards = buildstack.setuptools.shard(
+			testids = ["a", "b", "c", "d"],
+			durations = {"a": 4, "b": 3, "c": 2, "d": 1},
+			count = 2,
+			first = set(["d"]))
+		self.assertEqual(shards, [["d", "b", "c"], ["a"]])
+
+	def test_runner_failfast(self):
+		with open("test_foo.py", "w") as fp:
+			fp.write("import unittest\nclass T(unittest.TestCase):\n\tdef test_a(self): self.fail()\n\tdef test_b(self): pass\n")
+		with open("ids.json", "w") as fp:
+			json.dump(["test_foo.T.test_a", "test_foo.T.test_b"], fp)
+		returncode = subprocess.call((sys.executable, buildstack.setuptools.RUNNER, "run", "ids.json", "out.json", "failfast"), stderr = fckit.DEVNULL)
+		self.assertEqual(returncode, 1)
+		with open("out.json") as fp:
+			self.assertEqual([record["id"] for record in json.load(fp)], ["test_foo.T.test_a"])
+
+	def test_runner(self):
+		with open("test_foo.py", "w") as fp:
+			fp.write("import unittest\nclass T(unittest.TestCase):\n\tdef test_ok(self): pass\n\tdef test_ko(self): self.fail()\n")
+		subprocess.check_call((sys.executable, buildstack.setuptools.RUNNER, "discover", "", "ids.json"))
+		subprocess.check_call((sys.executable, buildstack.setuptools.RUNNER, "run", "ids.json", "out.json"), stderr = fckit.DEVNULL)
+		with open("out.json") as fp:
+			statuses = {record["id"]: record["status"] for record in json.load(fp)}
+		self.assertEqual(statuses, {"test_foo.T.test_ok": "success", "test_foo.T.test_ko": "failure"})
+
+	def test_coverage(self):
+		with open("foo.py", "w") as fp:
+			fp.write("def foo(): return 1\n")
+		with open("test_foo.py", "w") as fp:
+			fp.write("import unittest, foo\nclass T(unittest.TestCase):\n\tdef test_foo(self): foo.foo()\n\tdef test_bar(self): pass\n")
+		with open("ids.json", "w") as fp:
+			json.dump(["test_foo.T.test_foo", "test_foo.T.test_bar"], fp)
+		subprocess.check_call((sys.executable, buildstack.setuptools.RUNNER, "run", "ids.json", "out.json", "cover"), stderr = fckit.DEVNULL)
+		with open("out.json") as fp:
+			files = {record["id"]: record["files"] for record in json.load(fp)}
+		self.assertEqual(files, {"test_foo.T.test_foo": ["foo.py", "test_foo.py"], "test_foo.T.test_bar": ["test_foo.py"]})
+
+	def test_runner_sigterm_restored(self):
+		handler = signal.getsignal(signal.SIGTERM)
+		unittest.TextTestRunner(stream = StringIO.StringIO(), resultclass = buildstack.testrunner.TimedResult).run(unittest.TestSuite())
+		self.assertIs(signal.getsignal(signal.SIGTERM), handler)
+
+	def test_report(self):
+		records = [{"id": "t%i" % i, "duration": i} for i in range(12)]
+		lines = buildstack.testrunner.report(records, count = 2)
+		self.assertEqual(lines, ["slowest tests:", "   11.00s t11", "   10.00s t10"])
+
+	def test_select(self):
+		history = {
+			"a": {"status": "success", "files": ["foo.py"]},
+			"b": {"status": "success", "files": ["bar.py"]},
+			"c": {"status": "failure", "files": ["bar.py"]},
+			"d": {"status": "success"},
+		}
+		self.assertEqual(
+			buildstack.setuptools.select_tests(["a", "b", "c", "d", "e"], history, ["./foo.py"]),
+			["a", "c", "d", "e"])
+
+class AutotoolsTest(WorkdirTestCase):
+
+	PATHS = ((buildstack.autotools, "CACHE_PATH", "cache"),)
+
+	def _flush(self):
+		targets = buildstack.Targets()
+		targets.append("compile")
+		return list(buildstack.autotools.on_flush("configure.ac", targets))
+
+	def test_bootstrap(self):
+		with open("configure.ac", "w") as fp:
+			fp.write("AC_INIT([foo], [1.0])\nAC_CONFIG_HEADERS([config.h])\n")
+		with open("Makefile.am", "w") as fp:
+			fp.write("bin_PROGRAMS = foo\n")
+		cache_file = buildstack.autotools.get_cache_file()
+		self.assertEqual(os.path.dirname(cache_file), buildstack.autotools.CACHE_PATH)
+		bootstrap = [
+			("libtoolize",),
+			("aclocal",),
+			("autoconf",),
+			("autoheader",),
+			("automake", "--add-missing"),
+			("sh", "-c", "cd \"$0\" && exec \"$@\"", ".buildstack/build/default", "../../../configure", "--cache-file=%s" % cache_file),
+			("make", "-C", ".buildstack/build/default", "all")]
+		self.assertEqual(self._flush(), bootstrap)
+		self.assertEqual(os.getcwd(), self.dirname)
+		for path in ("configure", "Makefile.in", ".buildstack/build/default/Makefile"): # as generated above
+			open(path, "w").close()
+		self.assertEqual(self._flush(), bootstrap[-1:])
+		os.remove(".buildstack/build/default/Makefile")
+		self.assertEqual(self._flush(), bootstrap[-2:])
+		with open("Makefile.am", "a") as fp:
+			fp.write("foo_SOURCES = foo.c\n")
+		self.assertEqual(self._flush(), bootstrap)
+
+	def test_failed_configure(self):
+		with open("configure.ac", "w") as fp:
+			fp.write("AC_INIT([foo], [1.0])\n")
+		targets = buildstack.Targets()
+		targets.append("compile")
+		for res in buildstack.autotools.on_flush("configure.ac", targets):
+			if "--cache-file=%s" % buildstack.autotools.get_cache_file() in res:
+				open(buildstack.autotools.get_cache_file(), "w").close()
+				break # configure failed
+		self.assertTrue(os.path.exists(buildstack.autotools.get_cache_file()))
+		self._flush()
+		self.assertFalse(os.path.exists(buildstack.autotools.get_cache_file())) # removed before the next attempt
+
+	def test_profile(self):
+		with open("configure.ac", "w") as fp:
+			fp.write("AC_INIT([foo], [1.0])\n")
+		environ = dict(os.environ)
+		try:
+			os.environ["BUILDSTACK_PROFILE"] = "debug"
+			self.assertEqual(buildstack.autotools.get_build_dir(), ".buildstack/build/debug")
+			self.assertEqual(self._flush()[-1], ("make", "-C", ".buildstack/build/debug", "all"))
+			os.environ["BUILDSTACK_PROFILE"] = "release"
+			self.assertEqual(self._flush()[-2:], [
+				("sh", "-c", "cd \"$0\" && exec \"$@\"", ".buildstack/build/release", "../../../configure", "--cache-file=%s" % buildstack.autotools.get_cache_file()),
+				("make", "-C", ".buildstack/build/release", "all")])
+			targets = buildstack.Targets()
+			targets.append("clean")
+			self.assertEqual(list(buildstack.autotools.on_flush("configure.ac", targets)), [
+				("@remove", ".buildstack/build/release")])
+			targets = buildstack.Targets()
+			targets.append("compile")
+			targets.append("clean")
+			self.assertEqual(list(buildstack.autotools.on_flush("configure.ac", targets))[-2:], [
+				("make", "-C", ".buildstack/build/release", "all"),
+				("@remove", ".buildstack/build/release")]) # whatever its position
+		finally:
+			os.environ.clear()
+			os.environ.update(environ)
+
+class AnsibleTest(WorkdirTestCase):
+
+	PATHS = ((buildstack.ansible, "CACHE_PATH", "cache"),)
+
+	def _galaxy(self, args):
+		"stand-in for ansible-galaxy install: install the role and a dependency into the roles path"
+		self.assertEqual(args[:3], ("ansible-galaxy", "install", "--roles-path"))
+		src, version, name = args[4].split(",")
+		for dirname in (name, "common"):
+			os.makedirs(os.path.join(args[3], dirname, "meta"))
+		with open(os.path.join(args[3], name, "meta", ".galaxy_install_info"), "w") as fp:
+			fp.write("version: %s\n" % (version or "''"))
+
+	def _get(self):
+		gen = buildstack.ansible.on_get("playbook.yml", buildstack.Targets(), None)
+		fetched = []
+		for res in gen:
+			if res[0] == "@parallel":
+				for label, args in res[1:]:
+					self._galaxy(args)
+					fetched.append(label)
+			elif res[0] != "@trace":
+				self._galaxy(res)
+				fetched.append(res[4].split(",")[2])
+		return fetched
+
+	def test_parse_requirement(self):
+		self.assertEqual(buildstack.ansible.parse_requirement("user.role,1.0"), ("user.role", "1.0", "user.role"))
+		self.assertEqual(
+			buildstack.ansible.parse_requirement({"src": "https://example.org/repo.git", "scm": "git", "version": 2.1}),
+			("git+https://example.org/repo.git", "2.1", "repo"))
+		self.assertEqual(buildstack.ansible.parse_requirement({"src": "user.role", "name": "foo"}), ("user.role", None, "foo"))
+
+	def test_get(self):
+		with open("requirements.yml", "w") as fp:
+			fp.write("- src: user.a\n  version: 1.0\n- src: user.b\n  version: v2\n- src: user.c\n")
+		self.assertEqual(sorted(self._get()), ["user.a", "user.b", "user.c"])
+		self.assertEqual(sorted(os.listdir("roles")), ["common", "user.a", "user.b", "user.c"])
+		self.assertEqual(buildstack.ansible.get_installed_version("roles/user.a"), "1.0")
+		self.assertTrue(os.path.isdir("cache/user.b/v2"))
+		self.assertEqual(sorted(os.listdir("cache")), ["user.a", "user.b"])
+		# the versioned roles are cached, the unversioned one is fetched again:
+		fckit.remove("roles")
+		self.assertEqual(self._get(), ["user.c"])
+		self.assertEqual(sorted(os.listdir("roles")), ["common", "user.a", "user.b", "user.c"])
+		removed = []
+		for res in buildstack.ansible.on_clean("playbook.yml", buildstack.Targets()):
+			self.assertEqual(res[0], "@remove")
+			fckit.remove(*res[1:]) # as the builtin does
+			removed.append(res[1])
+		self.assertEqual(removed, ["roles/user.a", "roles/user.b", "roles/user.c"])
+		self.assertEqual(os.listdir("roles"), ["common"])
+
+	def test_get_dependencies(self):
+		os.makedirs("cache/user.a/1.0/meta")
+		with open("cache/user.a/1.0/meta/main.yml", "w") as fp:
+			fp.write("dependencies:\n  - role: user.dep\n  - src: user.pinned\n    version: 2\n  - local\n")
+		with open("requirements.yml", "w") as fp:
+			fp.write("- src: user.a\n  version: 1.0\n")
+		self.assertEqual(sorted(self._get()), ["user.dep", "user.pinned"]) # user.a is cached
+		self.assertEqual(sorted(os.listdir("roles")), ["common", "user.a", "user.dep", "user.pinned"])
+		self.assertTrue(os.path.isdir("cache/user.pinned/2"))
+
+	def test_get_concurrent(self):
+		with open("requirements.yml", "w") as fp:
+			fp.write("- src: user.a\n  version: 1.0\n")
+		galaxy = self._galaxy
+		def concurrent(args): # another workspace caches the same role meanwhile
+			galaxy(args)
+			os.makedirs("cache/user.a/1.0/meta")
+		self._galaxy = concurrent
+		self.assertEqual(self._get(), ["user.a"])
+		self.assertTrue(os.path.isdir("roles/user.a"))
+
+	def test_syntax_check(self):
+		for path, text in (
+			("site.yml", "- hosts: all\n  roles:\n    - web\n    - role: user.db\n"),
+			("db.yml", "- hosts: db\n  tasks:\n    - include_tasks: tasks/db.yml\n"),
+			("all.yml", "- import_playbook: site.yml\n- import_playbook: db.yml\n"),
+			("tasks/db.yml", "- name: ping\n  ping:\n"),
+			("roles/web/tasks/main.yml", "- name: ping\n  ping:\n"),
+			("group_vars/all.yml", "- hosts: all\n"),
+			("requirements.yml", "- src: user.db\n")):
+			if not os.path.exists(os.path.dirname(path) or "."):
+				os.makedirs(os.path.dirname(path))
+			with open(path, "w") as fp:
+				fp.write(text)
+		self.assertEqual(buildstack.ansible.get_playbooks("roles"), ["all.yml", "db.yml", "site.yml"])
+		check = lambda: [res for res in buildstack.ansible.on_test("site.yml", buildstack.Targets()) if res[0] != "@trace"]
+		self.assertEqual(check(), [("@parallel",) + tuple(
+			(path, ("ansible-playbook", "--syntax-check", path)) for path in ("all.yml", "db.yml", "site.yml"))])
+		self.assertEqual(check(), [])
+		with open("roles/web/tasks/main.yml", "a") as fp:
+			fp.write("- name: pong\n  ping:\n")
+		self.assertEqual(check(), [("@parallel",) + tuple(
+			(path, ("ansible-playbook", "--syntax-check", path)) for path in ("all.yml", "site.yml"))])
+		with open("tasks/db.yml", "a") as fp:
+			fp.write("- name: pong\n  ping:\n")
+		gen = buildstack.ansible.on_test("site.yml", buildstack.Targets())
+		self.assertEqual(next(gen)[0], "@trace") # site.yml unchanged
+		self.assertEqual(next(gen)[0], "@parallel")
+		exc = buildstack.Error("db.yml", "failed")
+		exc.returncodes = {"all.yml": None, "db.yml": 4} # aborted, failed
+		self.assertRaises(buildstack.Error, gen.throw, exc)
+		self.assertEqual(check(), [("@parallel",) + tuple(
+			(path, ("ansible-playbook", "--syntax-check", path)) for path in ("all.yml", "db.yml"))])
+		with open("tasks/db.yml", "a") as fp:
+			fp.write("- name: pang\n  ping:\n")
+		gen = buildstack.ansible.on_test("site.yml", buildstack.Targets())
+		self.assertEqual(next(gen)[0], "@trace") # site.yml unchanged
+		self.assertEqual(next(gen)[0], "@parallel")
+		exc.returncodes = {"all.yml": 0, "db.yml": 4}
+		self.assertRaises(buildstack.Error, gen.throw, exc)
+		self.assertEqual(check(), [("ansible-playbook", "--syntax-check", "db.yml")]) # all.yml passed
+
+class MavenTest(WorkdirTestCase):
+
+	PATHS = ((buildstack.maven, "LOCAL_REPOSITORY_PATH", "repository"),)
+
+	POM = """<project xmlns="http://maven.apache.org/POM/4.0.0"><modules>%s</modules></project>"""
+
+	class Vcs(object):
+		revision = "2"
+		changes = []
+		def get_revision(self): return self.revision
+		def get_changes(self, revision): return self.changes
+
+	def setUp(self):
+		super(MavenTest, self).setUp()
+		for dirname, modules in ((".", ("a", "b")), ("a", ()), ("b", ("c",)), ("b/c", ())):
+			if not os.path.exists(dirname):
+				os.mkdir(dirname)
+			with open(os.path.join(dirname, "pom.xml"), "w") as fp:
+				fp.write(self.POM % "".join("<module>%s</module>" % module for module in modules))
+
+	def test_modules(self):
+		self.assertEqual(buildstack.maven.get_modules("pom.xml"), ["a", "b", "b/c"])
+
+	def test_changed_modules(self):
+		modules = ["a", "b", "b/c"]
+		self.assertEqual(buildstack.maven.get_changed_modules(modules, ["b/c/src/X.java", "b/pom.xml", "README.md"]), ["b", "b/c"])
+		self.assertEqual(buildstack.maven.get_changed_modules(modules, []), [])
+		self.assertIsNone(buildstack.maven.get_changed_modules(modules, ["pom.xml"]))
+
+	def flush(self, vcs, name = "test"):
+		targets = buildstack.Targets()
+		targets.append(name)
+		return [res for res in buildstack.maven.on_flush("pom.xml", targets, vcs) if res[0] == "mvn"]
+
+	def test_reactor_selection(self):
+		vcs = self.Vcs()
+		self.assertEqual(self.flush(vcs), [("mvn", "--update-snapshots", "--file", "pom.xml", "test")]) # first build
+		vcs.changes = ["a/src/X.java"]
+		self.assertEqual(self.flush(vcs)[0][-4:], ("--projects", "a", "--also-make-dependents", "test"))
+		vcs.changes = []
+		self.assertEqual(self.flush(vcs), []) # up-to-date
+		self.assertEqual(len(self.flush(vcs, "install")), 1) # not built yet
+		self.assertEqual(len(self.flush(vcs, "install")), 1) # artifacts installed every time
+		self.assertEqual(len(self.flush(vcs, "clean")), 1)
+		self.assertEqual(self.flush(vcs), [("mvn", "--update-snapshots", "--file", "pom.xml", "test")]) # outputs removed by clean
+
+	def test_get(self):
+		targets = buildstack.Targets()
+		for res in buildstack.maven.on_get("pom.xml", targets, None):
+			pass
+		targets.append("clean")
+		targets.append("compile")
+		res = list(buildstack.maven.on_flush("pom.xml", targets, self.Vcs()))
+		self.assertEqual(res[0], ("@parallel",
+			("get", ("mvn", "--define", "maven.artifact.threads=16", "--file", "pom.xml", "dependency:go-offline")),
+			("clean", ("mvn", "--file", "pom.xml", "clean"))))
+		self.assertEqual(res[1][-1], "compile")
+
+	def test_offline(self):
+		vcs = self.Vcs()
+		vcs.revision = None # no vcs
+		self.assertEqual(self.flush(vcs)[0][1], "--update-snapshots") # cold local repository
+		self.assertEqual(self.flush(vcs)[0][1], "--update-snapshots")
+		os.mkdir("repository")
+		self.assertEqual(self.flush(vcs)[0][1], "--offline") # warm
+		self.assertEqual(self.flush(vcs, "package")[0][1], "--update-snapshots") # new goals
+		with open("a/pom.xml", "a") as fp:
+			fp.write("<!-- new dependency -->")
+		self.assertEqual(self.flush(vcs)[0][1], "--update-snapshots") # new poms
+
+	def test_failure(self):
+		vcs = self.Vcs()
+		vcs.revision = None # no vcs
+		os.mkdir("repository")
+		self.flush(vcs)
+		self.assertEqual(self.flush(vcs)[0][1], "--offline")
+		targets = buildstack.Targets()
+		targets.append("test")
+		results = buildstack.maven.on_flush("pom.xml", targets, vcs)
+		self.assertEqual(next(results)[1], "--offline")
+		results.close() # mvn failed, e.g. a plugin missing offline
+		self.assertEqual(self.flush(vcs)[0][1], "--update-snapshots")
+
+class CargoTest(WorkdirTestCase):
+
+	def test_package_name(self):
+		with open("Cargo.toml", "w") as fp:
+			fp.write("[package]\nversion = \"0.1.0\"\nname = \"foo\"\n\n[dependencies]\nname = \"bar\"\n")
+		self.assertEqual(buildstack.cargo.get_package_name("Cargo.toml"), "foo")
+		with open("Cargo.toml", "w") as fp:
+			fp.write("[workspace]\nmembers = [\"foo\"]\n")
+		self.assertIsNone(buildstack.cargo.get_package_name("Cargo.toml"))
+
+	def test_target_dir(self):
+		os.makedirs("ws/member")
+		with open("ws/Cargo.toml", "w") as fp:
+			fp.write("[workspace]\nmembers = [\"member\"]\n")
+		with open("ws/member/Cargo.toml", "w") as fp:
+			fp.write("[package]\nname = \"member\"\n")
+		os.chdir("ws/member")
+		self.assertEqual(buildstack.cargo.get_workspace_root(), os.path.join(self.dirname, "ws"))
+		self.assertIsNone(buildstack.cargo.get_target_dir()) # cargo default, ws/target
+		with open("../Cargo.toml", "a") as fp:
+			fp.write("\n[workspace.metadata.buildstack]\nshared-target = true\n")
+		self.assertEqual(
+			buildstack.cargo.get_target_dir(),
+			os.path.join(buildstack.cargo.TARGET_PATH, hashlib.sha1(self.dirname).hexdigest()[:12])) # keyed by the parent of ws
+		clone = os.path.join(self.dirname, "ws", buildstack.MATRIX_PATH, "debug")
+		os.makedirs(clone)
+		os.chdir(clone)
+		with open("Cargo.toml", "w") as fp:
+			fp.write("[package]\nname = \"ws\"\n\n[package.metadata.buildstack]\nshared-target = true\n")
+		self.assertIsNone(buildstack.cargo.get_target_dir()) # matrix clones never share
+
+	def test_parse_bench(self):
+		self.assertEqual(buildstack.cargo.parse_bench([
+			"test bench_add ... bench:       1,234 ns/iter (+/- 56)\n",
+			"test tests::it_works ... ignored\n",
+			"fib 20                  time:   [26.029 us 26.251 us 26.505 us]\n",
+			"parse                   time:   [1.5000 ms 1.5100 ms 1.5200 ms]\n",
+		]), {"bench_add": 1234, "fib 20": 26251, "parse": 1510000})
+
+	def test_bench(self):
+		results = buildstack.cargo.run_bench("Cargo.toml")
+		self.assertEqual(next(results), ("@output", "cargo", "bench"))
+		self.assertEqual(results.send("test add ... bench:       1,000 ns/iter (+/- 5)\n"), ("@echo", "add: 1000 ns/iter"))
+		self.assertEqual(list(results), [])
+		results = buildstack.cargo.run_bench("Cargo.toml")
+		next(results)
+		self.assertEqual(results.send("test add ... bench:       1,100 ns/iter (+/- 5)\n"), ("@echo", "add: 1100 ns/iter (+10.0%)"))
+		self.assertEqual(list(results), [])
+		results = buildstack.cargo.run_bench("Cargo.toml")
+		next(results)
+		self.assertEqual(results.send("custom harness: 1 op/s\n"), ("@echo", "custom harness: 1 op/s"))
+
+	def test_clean_single_member(self):
+		with open("Cargo.toml", "w") as fp:
+			fp.write("[workspace]\nmembers = [\"a\"]\n")
+		os.makedirs("a/src")
+		with open("a/Cargo.toml", "w") as fp:
+			fp.write("[package]\nname = \"a\"\nversion = \"0.1.0\"\n")
+		targets = buildstack.Targets()
+		targets.append("clean")
+		self.assertEqual(list(buildstack.cargo.on_flush("Cargo.toml", targets)), [
+			("cargo", "clean", "-p", "a")]) # not the whole shared target directory
+
+	def test_flush(self):
+		with open("Cargo.toml", "w") as fp:
+			fp.write("[package]\nname = \"foo\"\n")
+		targets = buildstack.Targets()
+		for name in ("clean", "compile", "test"):
+			targets.append(name)
+		self.assertEqual(list(buildstack.cargo.on_flush("Cargo.toml", targets)), [
+			("cargo", "clean", "-p", "foo"),
+			("cargo", "build"),
+			("cargo", "test")])
+
+	def test_profile(self):
+		with open("Cargo.toml", "w") as fp:
+			fp.write("[package]\nname = \"foo\"\n\n[profile.ci]\ndebug = false\n")
+		environ = dict(os.environ)
+		try:
+			for profileid, args in (("release", ["--release"]), ("ci", ["--profile", "ci"]), ("other", [])):
+				os.environ["BUILDSTACK_PROFILE"] = profileid
+				self.assertEqual(buildstack.cargo.get_profile_args("Cargo.toml"), args)
+			targets = buildstack.Targets()
+			for name in ("compile", "test", "package"):
+				targets.append(name)
+			os.environ["BUILDSTACK_PROFILE"] = "release"
+			self.assertEqual(list(buildstack.cargo.on_flush("Cargo.toml", targets)), [
+				("cargo", "build", "--release"),
+				("cargo", "test", "--release"),
+				("cargo", "package")])
+		finally:
+			os.environ.clear()
+			os.environ.update(environ)
+
+	def test_workspace(self):
+		with open("Cargo.toml", "w") as fp:
+			fp.write("[workspace]\nmembers = [\n\t\"crates/*\",\n]\nexclude = [\"crates/old\"]\n")
+		for name, manifest in (
+			("a", "[dependencies]\nlog = \"0.4\"\n"),
+			("b", "[dependencies]\na = { path = \"../a\", version = \"0.1\" }\n[dev-dependencies]\nc = { path = \"../c\" }\n"),
+			("c", "[build-dependencies.a]\npath = \"../a\"\n"),
+			("d", "[target.'cfg(unix)'.dependencies]\nb = { path = \"../b\" }\n"),
+			("old", "")):
+			os.makedirs("crates/%s/src" % name)
+			with open("crates/%s/Cargo.toml" % name, "w") as fp:
+				fp.write("[package]\nname = \"%s\"\nversion = \"0.1.0\"\n\n%s" % (name, manifest))
+		members = buildstack.cargo.get_workspace_members("Cargo.toml")
+		self.assertEqual(members, {name: "crates/%s" % name for name in "abcd"})
+		self.assertEqual(buildstack.cargo.get_publish_waves(members), [["a"], ["b", "c"], ["d"]])
+		targets = buildstack.Targets()
+		for name in ("clean", "test", "publish"):
+			targets.append(name)
+		self.assertEqual(list(buildstack.cargo.on_flush("Cargo.toml", targets)), [
+			("cargo", "clean", "-p", "a", "-p", "b", "-p", "c", "-p", "d"),
+			("cargo", "test", "--workspace", "--no-run"),
+			("@parallel",) + tuple((name, ("cargo", "test", "-p", name)) for name in "abcd"),
+			("cargo", "publish", "-p", "a"),
+			("@parallel", ("b", ("cargo", "publish", "-p", "b")), ("c", ("cargo", "publish", "-p", "c"))),
+			("cargo", "publish", "-p", "d")])
+
 if __name__ == "__main__": unittest.main(verbosity = 2)